@@ -1,29 +1,58 @@
 """A bot which downloads various files from chats."""
 import os
-import shutil
-import time
+from datetime import datetime
 
+from sqlalchemy import String, delete, func, literal, select, update
 from telethon import TelegramClient, events, types
-from telethon.errors import BadMessageError, FloodWaitError
+from telethon.errors import BadMessageError
 
 from archivebot.config import config
+from archivebot.db import async_engine
 from archivebot.helper import (
     UnknownUser,
+    format_optional_size,
     get_info_text,
     get_option_for_subscriber,
     get_peer_information,
+    get_size_option_for_subscriber,
     get_username,
     help_text,
     possible_media,
+    process_filter,
     should_accept_message,
 )
-from archivebot.helper.file import create_file, create_zips, get_chat_path, init_zip_dir
+from archivebot.helper.blob import delete_unreferenced_blobs, remove_blob_files
+from archivebot.helper.cache import entity_cache, subscriber_cache
+from archivebot.helper.download import DownloadJob, download_queue
+from archivebot.helper.export import export_files, parse_size
+from archivebot.helper.file import (
+    create_file,
+    get_media_id,
+    init_zip_dir,
+    reserved_names,
+)
+from archivebot.helper.filesystem import filesystem
+from archivebot.helper.recovery import recover_downloads
+from archivebot.helper.retry import call_with_retries
+from archivebot.helper.scan import (
+    SCAN_BATCH_SIZE,
+    SCAN_QUEUE_LIMIT,
+    ScanProgress,
+    get_remaining_scan_filters,
+)
+from archivebot.helper.scheduler import LIVE, SCAN
 from archivebot.helper.session import session_wrapper
+from archivebot.helper.shard import is_own_chat, shard_name
+from archivebot.metrics import metrics
 from archivebot.models import File, Subscriber  # noqa
 from archivebot.sentry import sentry
+from archivebot.storage import storage
 
 if config["telegram"]["userbot"]:
     NAME = "archivebot"
+    # Userbots of several shards need session files of their own.
+    if shard_name != "default":
+        NAME = f"archivebot_{shard_name}"
 else:
     NAME = config["telegram"]["api_key"].split(":")[0]
 
@@ -31,10 +60,6 @@ archive = TelegramClient(
     NAME, config["telegram"]["app_api_id"], config["telegram"]["app_api_hash"]
 )
 
-# Ensure save directory for files exists
-if not os.path.exists(config["download"]["target_dir"]):
-    os.mkdir(config["download"]["target_dir"])
-
 
 @archive.on(events.NewMessage(pattern="/help", outgoing=True))
 @session_wrapper()
@@ -48,8 +73,8 @@ async def help(event, session):
 async def info(event, session):
     """Send a the information about the current user settings."""
     to_id, to_type = get_peer_information(event.message.to_id)
-    subscriber = Subscriber.get_or_create(session, to_id, to_type, event.message)
-    return get_info_text(subscriber)
+    subscriber = await Subscriber.get_or_create(session, to_id, to_type, event.message)
+    return get_info_text(subscriber, process_filter)
 
 
 @archive.on(events.NewMessage(pattern="/set_name", outgoing=True))
@@ -58,25 +83,27 @@ async def set_name(event, session):
     """Set the name of the current chat (also affects the saving directory."""
     to_id, to_type = get_peer_information(event.message.to_id)
     new_chat_name = event.message.message.split(" ", maxsplit=1)[1].strip()
-    # We already save to zips, prevent that
-    if new_chat_name == "zips":
+    # We already use some directories for other stuff, prevent that
+    if new_chat_name in reserved_names:
         return "Invalid chat name. Pick another."
 
-    subscriber = Subscriber.get_or_create(
+    subscriber = await Subscriber.get_or_create(
         session, to_id, to_type, event.message, chat_name=new_chat_name
     )
 
-    old_chat_path = get_chat_path(subscriber.chat_name)
-    new_chat_path = get_chat_path(new_chat_name)
+    old_chat_path = storage.get_chat_path(subscriber.chat_name)
+    new_chat_path = storage.get_chat_path(new_chat_name)
 
     # Handle any command that tries to escape the download directory
-    new_real_path = os.path.realpath(new_chat_path)
-    target_real_path = os.path.realpath(config["download"]["target_dir"])
+    new_real_path = await filesystem.realpath(
+        os.path.join(config["download"]["target_dir"], new_chat_name)
+    )
+    target_real_path = await filesystem.realpath(config["download"]["target_dir"])
     if (
         not new_real_path.startswith(target_real_path)
         or new_real_path == target_real_path
     ):
-        user = await archive.get_entity(types.PeerUser(event.message.from_id))
+        user = await entity_cache.get_entity(archive, event.message.from_id)
         sentry.captureMessage(
             "User tried to escape directory.",
             extra={
@@ -90,18 +117,30 @@ async def set_name(event, session):
         return "Please stop fooling around and don't try to escape the directory. I have been notified about this."
 
     # Check whether we already have a chat with this name
-    if (
-        session.query(Subscriber)
-        .filter(Subscriber.chat_name == new_chat_name)
-        .one_or_none()
-    ):
+    result = await session.execute(
+        select(Subscriber).where(Subscriber.chat_name == new_chat_name)
+    )
+    if result.scalars().one_or_none():
         return "Chat name already exists. Please choose another one."
 
     # Move the old directory to the new location
     elif old_chat_path != new_chat_path:
+        old_chat_name = subscriber.chat_name
         subscriber.chat_name = new_chat_name
-        if os.path.exists(old_chat_path):
-            os.rename(old_chat_path, new_chat_path)
+        subscriber_cache.update(subscriber)
+        await storage.move_chat(old_chat_name, new_chat_name)
+
+        # Update the paths of all known files in a single statement.
+        await session.execute(
+            update(File)
+            .where(File.subscriber == subscriber)
+            .where(File.file_path.startswith(old_chat_path))
+            .values(
+                file_path=literal(new_chat_path, String)
+                + func.substr(File.file_path, len(old_chat_path) + 1)
+            )
+            .execution_options(synchronize_session=False)
+        )
         return "Chat name changed."
 
 
@@ -114,6 +153,7 @@ async def set_verbose(event, session):
         return
 
     subscriber.verbose = verbose
+    subscriber_cache.update(subscriber)
     return f"I'm now configured to be {'verbose' if verbose else 'sneaky'}."
 
 
@@ -126,11 +166,62 @@ async def allow_duplicates(event, session):
         return
 
     subscriber.allow_duplicates = allowed
+    subscriber_cache.update(subscriber)
     return (
         f"I'm now configured to {'' if allowed else 'not'} allow duplicate file names."
     )
 
 
+@archive.on(events.NewMessage(pattern="/max_size", outgoing=True))
+@session_wrapper()
+async def set_max_size(event, session):
+    """Set the maximum size of files for this chat."""
+    subscriber, size = await get_size_option_for_subscriber(event, session)
+    if subscriber is None:
+        return
+
+    subscriber.max_file_size = size
+    subscriber_cache.update(subscriber)
+    return f"Maximum file size: {format_optional_size(size)}."
+
+
+@archive.on(events.NewMessage(pattern="/quota", outgoing=True))
+@session_wrapper()
+async def set_quota(event, session):
+    """Set the storage quota for this chat."""
+    subscriber, size = await get_size_option_for_subscriber(event, session)
+    if subscriber is None:
+        return
+
+    subscriber.quota = size
+    subscriber_cache.update(subscriber)
+    return f"Storage quota: {format_optional_size(size)}."
+
+
+@archive.on(events.NewMessage(pattern="/allow_mime", outgoing=True))
+@session_wrapper()
+async def allow_mime_types(event, session):
+    """Set the mime types, which are archived in this chat."""
+    to_id, to_type = get_peer_information(event.message.to_id)
+    subscriber = await Subscriber.get_or_create(session, to_id, to_type, event.message)
+
+    subscriber.allowed_mime_types = " ".join(event.message.message.lower().split()[1:])
+    subscriber_cache.update(subscriber)
+    return f"Allowed mime types: {subscriber.allowed_mime_types or 'all'}."
+
+
+@archive.on(events.NewMessage(pattern="/deny_mime", outgoing=True))
+@session_wrapper()
+async def deny_mime_types(event, session):
+    """Set the mime types, which are never archived in this chat."""
+    to_id, to_type = get_peer_information(event.message.to_id)
+    subscriber = await Subscriber.get_or_create(session, to_id, to_type, event.message)
+
+    subscriber.denied_mime_types = " ".join(event.message.message.lower().split()[1:])
+    subscriber_cache.update(subscriber)
+    return f"Denied mime types: {subscriber.denied_mime_types or 'none'}."
+
+
 @archive.on(events.NewMessage(pattern="/sort_by_user", outgoing=True))
 @session_wrapper()
 async def set_sort_by_user(event, session):
@@ -139,6 +230,7 @@ async def set_sort_by_user(event, session):
     if subscriber is None:
         return
     subscriber.sort_by_user = sorting
+    subscriber_cache.update(subscriber)
     return f"{'Sorting' if sorting else 'Not sorting'} by user."
 
 
@@ -147,7 +239,7 @@ async def set_sort_by_user(event, session):
 async def accepted_media_types(event, session):
     """Set the allowed media types for this chat."""
     to_id, to_type = get_peer_information(event.message.to_id)
-    subscriber = Subscriber.get_or_create(session, to_id, to_type, event.message)
+    subscriber = await Subscriber.get_or_create(session, to_id, to_type, event.message)
 
     # Convert the incoming text into an boolean
     arguments = event.message.message.lower().split(" ")[1:]
@@ -160,6 +252,7 @@ async def accepted_media_types(event, session):
     accepted_media.sort()
 
     subscriber.accepted_media = " ".join(accepted_media)
+    subscriber_cache.update(subscriber)
     return f"Now accepting following media types: {accepted_media}."
 
 
@@ -169,9 +262,12 @@ async def start(event, session):
     """Subscribe to this specific chat."""
     to_id, to_type = get_peer_information(event.message.to_id)
 
-    subscriber = Subscriber.get_or_create(session, to_id, to_type, event.message)
+    subscriber = await Subscriber.get_or_create(session, to_id, to_type, event.message)
     subscriber.active = True
+    # The chat is archived by the bot process, which received the command.
+    subscriber.shard = shard_name
     session.add(subscriber)
+    subscriber_cache.update(subscriber)
 
     return "Files posted in this chat will now be archived."
 
@@ -182,9 +278,10 @@ async def stop(event, session):
     """Unsubscribe from this specific chat."""
     to_id, to_type = get_peer_information(event.message.to_id)
 
-    subscriber = Subscriber.get_or_create(session, to_id, to_type, event.message)
+    subscriber = await Subscriber.get_or_create(session, to_id, to_type, event.message)
     subscriber.active = False
     session.add(subscriber)
+    subscriber_cache.update(subscriber)
 
     return "Files won't be archived any longer."
 
@@ -194,16 +291,25 @@ async def stop(event, session):
 async def clear_history(event, session):
     """Remove every downloaded file from the database and the file system."""
     to_id, to_type = get_peer_information(event.message.to_id)
-    subscriber = Subscriber.get_or_create(session, to_id, to_type, event.message)
-
-    chat_path = get_chat_path(subscriber.chat_name)
-    for known_file in subscriber.files:
-        session.delete(known_file)
-
-    if os.path.exists(chat_path):
-        shutil.rmtree(chat_path)
+    subscriber = await Subscriber.get_or_create(session, to_id, to_type, event.message)
+
+    download_queue.discard((subscriber.chat_id, subscriber.chat_type))
+    await session.execute(
+        delete(File)
+        .where(File.subscriber_chat_id == subscriber.chat_id)
+        .where(File.subscriber_chat_type == subscriber.chat_type)
+        .execution_options(synchronize_session=False)
+    )
+    subscriber.used_bytes = 0
+    # Deduplicated content, which is only used by this chat, would stay in the blob store.
+    blobs = {}
+    if config["download"]["deduplicate"]:
+        blobs = await session.run_sync(delete_unreferenced_blobs)
+    # The blobs are only removed, once nothing points to them anymore.
+    await session.commit()
 
-    session.commit()
+    await storage.remove_chat(subscriber.chat_name)
+    await filesystem.run(remove_blob_files, blobs)
 
     return "All files from this chat have been deleted."
 
@@ -211,134 +317,365 @@ async def clear_history(event, session):
 @archive.on(events.NewMessage(pattern="/scan_chat", outgoing=True))
 @session_wrapper()
 async def scan_chat(event, session):
-    """Scan the whole chat for files. Necessary for getting old files."""
+    """Scan the whole chat for files. Necessary for getting old files.
+
+    The history is fetched with server-side media filters and checked in batches.
+    After each batch the position is saved, so an interrupted scan can be resumed.
+    """
     to_id, to_type = get_peer_information(event.message.to_id)
-    subscriber = Subscriber.get_or_create(session, to_id, to_type, event.message)
+    subscriber = await Subscriber.get_or_create(session, to_id, to_type, event.message)
 
-    await event.respond("Starting full chat scan.")
-    async for message in archive.iter_messages(event.message.to_id):
-        try:
-            await process_message(session, subscriber, message, event, full_scan=True)
-        except BadMessageError:
-            # Ignore bad message errors
-            return
+    if subscriber.scan_filter is None:
+        text = "Starting full chat scan."
+    else:
+        text = "Resuming previous chat scan."
+    progress = ScanProgress(await event.respond(text))
+
+    for filter_name, message_filter in get_remaining_scan_filters(subscriber):
+        subscriber.scan_filter = filter_name
+
+        batch = []
+        async for message in archive.iter_messages(
+            event.message.to_id,
+            filter=message_filter,
+            offset_id=subscriber.scan_offset_id or 0,
+        ):
+            batch.append(message)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                await scan_batch(session, subscriber, batch, event, progress)
+                batch = []
+
+        if batch:
+            await scan_batch(session, subscriber, batch, event, progress)
+        subscriber.scan_offset_id = None
+
+    subscriber.scan_filter = None
+    await session.commit()
+
+    await progress.update(
+        f"{progress.get_text()} Waiting for the downloads to finish.", force=True
+    )
+    await download_queue.join((subscriber.chat_id, subscriber.chat_type))
+
+    return f"Full chat scan successful. Found {progress.queued} new files."
+
+
+async def scan_batch(session, subscriber, messages, event, progress):
+    """Process a batch of messages from the history of a chat.
+
+    Files that are already known are filtered with a single query.
+    The senders are resolved with retries first, so a flood wait doesn't abort the scan
+    and the transaction never waits for telegram.
+    """
+    media_ids = {message.id: get_media_id(message) for message in messages}
+    senders = await get_senders(
+        [message for message in messages if media_ids[message.id] is not None]
+    )
+    known_ids = await File.get_known_file_ids(
+        session,
+        subscriber,
+        [media_id for media_id in media_ids.values() if media_id is not None],
+    )
+
+    jobs = []
+    notices = []
+    for message in messages:
+        media_id = media_ids[message.id]
+        if media_id is None or media_id in known_ids or senders[message.id] is None:
+            continue
+
+        job = await process_message(
+            session,
+            subscriber,
+            message,
+            event,
+            senders[message.id],
+            notices,
+            full_scan=True,
+            check_exists=False,
+        )
 
-    return "Full chat scan successful."
+        if job is not None:
+            jobs.append(job)
+            # The same media may be posted several times within a batch.
+            known_ids.add(media_id)
+
+    # Remember our position, in case the scan gets interrupted.
+    # The whole batch is committed at once.
+    subscriber.scan_offset_id = messages[-1].id
+    await session.commit()
+
+    for job in jobs:
+        download_queue.put(job)
+    progress.queued += len(jobs)
+    for text in notices:
+        await call_with_retries(event.respond, text)
+
+    progress.scanned += len(messages)
+    await progress.update()
+
+    # Don't fetch more of the history, while the downloads are throttled.
+    await download_queue.wait_for_capacity(SCAN_QUEUE_LIMIT, SCAN)
 
 
 @archive.on(events.NewMessage(pattern="/zip", outgoing=True))
 @session_wrapper()
 async def zip(event, session):
-    """Create 1.5GB(config["zip"]["volume_size"]) zips with all files collectd in this chat."""
+    """Create 1.5GB(config["zip"]["volume_size"]) volumes with all files collected in this chat.
+
+    The volumes are parts of a single tar archive and are uploaded as soon as they're written.
+    With `/zip new` only files, which have been downloaded since the last /zip, are exported.
+    """
     to_id, to_type = get_peer_information(event.message.to_id)
-    subscriber = Subscriber.get_or_create(session, to_id, to_type, event.message)
+    subscriber = await Subscriber.get_or_create(session, to_id, to_type, event.message)
+    arguments = event.message.message.lower().split(" ")[1:]
 
-    chat_path = get_chat_path(subscriber.chat_name)
-    if not os.path.exists(chat_path):
+    if not await storage.chat_exists(subscriber.chat_name):
         return "No files for this chat yet."
 
-    zip_dir = init_zip_dir(subscriber.chat_name)
-
-    text = "Zipping started, this might take some time. Please don't issue this command again until I'm finished."
-    await event.respond(text)
+    # Files downloaded while we're exporting, will be part of the next export.
+    export_started = datetime.now()
+    if "new" in arguments:
+        new_files = await File.get_downloaded_since(
+            session, subscriber, subscriber.exported_at
+        )
+        if len(new_files) == 0:
+            return "No new files since the last export."
+        files = storage.iter_existing_files(
+            subscriber.chat_name, [new_file.file_path for new_file in new_files]
+        )
+    else:
+        files = storage.iter_chat_files(subscriber.chat_name)
 
-    create_zips(subscriber.chat_name, zip_dir, chat_path)
+    # Don't keep the transaction open during the export.
+    await session.commit()
 
-    zip_files = sorted(os.listdir(zip_dir))
-    zip_files_count = len(zip_files)
+    zip_dir = await init_zip_dir(subscriber.chat_name)
 
-    text = f"Zipping is completed. I'll now start uploading {zip_files_count} file(s)."
+    text = "Zipping started, this might take some time. Please don't issue this command again until I'm finished."
     await event.respond(text)
 
-    for zip_file in zip_files:
-        zip_file_path = os.path.join(zip_dir, zip_file)
-        await archive.send_file(event.message.to_id, zip_file_path)
+    async def upload(path):
+        size = await filesystem.getsize(path)
+        with metrics.upload_seconds.time():
+            await archive.send_file(event.message.to_id, path)
+        metrics.export_bytes.inc(size)
+
+    try:
+        volume_count = await export_files(
+            os.path.join(zip_dir, f"{subscriber.chat_name}.tar"),
+            files,
+            parse_size(config["zip"]["volume_size"]),
+            upload,
+            storage.add_to_archive,
+        )
+    finally:
+        await filesystem.rmtree(zip_dir)
 
-    shutil.rmtree(zip_dir)
+    subscriber.exported_at = export_started
 
-    return "All files are uploaded :)"
+    return f"All files are uploaded in {volume_count} volume(s) :)"
 
 
-@archive.on(events.NewMessage())
+@archive.on(events.NewMessage(func=process_filter))
 @session_wrapper(addressed=False)
 async def process(event, session):
-    """Main entry for processing messages and downloading files."""
-    to_id, to_type = get_peer_information(event.message.to_id)
-    subscriber = Subscriber.get_or_create(session, to_id, to_type, event.message)
+    """Main entry for processing messages and downloading files.
 
-    tries = 3
-    current_try = 0
-    while tries < current_try:
-        try:
-            await process_message(session, subscriber, event.message, event)
-            return
-        except BadMessageError:
-            # Ignore bad message errors
+    Messages without media or from inactive chats never reach this handler.
+    Those are already dropped by the process_filter.
+    """
+    notices = []
+    try:
+        # Telegram is asked before the database, so no transaction waits for a flood wait.
+        user = await get_sender(event.message)
+        if user is None:
             return
-        except FloodWaitError as e:
-            # We got a flood wait error. Wait for the specified time and recursively retry
-            time.sleep(e.seconds + 1)
-        except TimeoutError:
-            # Timeout error. Just wait for 10 secs.
-            time.sleep(10)
 
-        current_try += 1
+        to_id, to_type = get_peer_information(event.message.to_id)
+        subscriber = await Subscriber.get_or_create(
+            session, to_id, to_type, event.message
+        )
+        # The chat has been started on another shard since the cache was loaded.
+        if not is_own_chat(subscriber):
+            subscriber_cache.update(subscriber)
+            return
 
+        with metrics.step_seconds.labels("process_message").time():
+            job = await process_message(
+                session, subscriber, event.message, event, user, notices
+            )
+    except BadMessageError:
+        # Ignore bad message errors
+        return
 
-async def process_message(session, subscriber, message, event, full_scan=False):
-    """Process a single message. Check if it has a file we want to download."""
-    user_id = None
-    try:
-        # If this message is forwarded, get the original sender.
-        if message.forward and message.forward.sender_id is not None:
-            user_id = message.forward.sender_id
-            user = await archive.get_entity(user_id)
+    # The file has to be committed, before the download workers can pick it up.
+    if job is not None:
+        await session.commit()
+        download_queue.put(job)
 
-            # A channel can be a sender as well, early return if the sender is no User
-            if not isinstance(user, types.User):
-                return
+    return "\n".join(notices)
 
-        else:
-            # Ignore messages with no sent user
-            if message.from_id is None:
-                return
 
-            user_id = message.from_id
-            user = await archive.get_entity(message.from_id)
+@archive.on(events.Album(func=process_filter.filter_album))
+@session_wrapper(addressed=False)
+async def process_album(event, session):
+    """Process all messages of an album, e.g. a group of photos, at once.
+
+    The whole group is admitted with a single subscriber lookup, a single query
+    for known files and a single commit. Afterwards all files are queued together,
+    so the workers download them concurrently.
+    The senders are resolved first, so the transaction never waits for telegram.
+    """
+    senders = await get_senders(event.messages)
+
+    to_id, to_type = get_peer_information(event.messages[0].to_id)
+    subscriber = await Subscriber.get_or_create(
+        session, to_id, to_type, event.messages[0]
+    )
+    # The chat has been started on another shard since the cache was loaded.
+    if not is_own_chat(subscriber):
+        subscriber_cache.update(subscriber)
+        return
 
-        # Check if we should accept this message
-        if not await should_accept_message(event, message, user, subscriber):
-            return
+    media_ids = {message.id: get_media_id(message) for message in event.messages}
+    known_ids = await File.get_known_file_ids(
+        session,
+        subscriber,
+        [media_id for media_id in media_ids.values() if media_id is not None],
+    )
 
-        # Create a new file. If it's not possible or not wanted, return None
-        new_file = await create_file(
-            session, event, subscriber, message, user, full_scan
+    jobs = []
+    notices = []
+    for message in event.messages:
+        media_id = media_ids[message.id]
+        user = senders[message.id]
+        if media_id is None or media_id in known_ids or user is None:
+            continue
+
+        with metrics.step_seconds.labels("process_message").time():
+            job = await process_message(
+                session, subscriber, message, event, user, notices, check_exists=False
+            )
+
+        if job is not None:
+            jobs.append(job)
+            known_ids.add(media_id)
+
+    # The files have to be committed, before the download workers can pick them up.
+    if jobs:
+        await session.commit()
+        for job in jobs:
+            download_queue.put(job)
+
+    return "\n".join(notices)
+
+
+async def get_sender(message):
+    """Get the user, who sent the file of a message. Returns None, if it's no user.
+
+    Flood waits and timeouts are retried without blocking the event loop.
+    This is done before any database access, so no transaction is kept open while waiting.
+    """
+    # If this message is forwarded, get the original sender.
+    if message.forward and message.forward.sender_id is not None:
+        user = await call_with_retries(
+            entity_cache.get_entity, archive, message.forward.sender_id
         )
-        if new_file is None:
+
+        # A channel can be a sender as well, early return if the sender is no User
+        if not isinstance(user, types.User):
+            return None
+
+    else:
+        # Ignore messages with no sent user
+        if message.from_id is None:
             return None
 
-        # Download the file
-        success = await message.download_media(str(new_file.file_path))
+        user = await call_with_retries(
+            entity_cache.get_entity, archive, message.from_id
+        )
+
+    # We only want messages from users
+    if not isinstance(user, (types.User, UnknownUser)):
+        return None
+
+    return user
 
-        # Download succeeded, if the result is not None
-        if success is not None:
-            # Mark the file as succeeded
-            new_file.success = True
-        session.commit()
 
-    except ValueError as e:
-        # Handle broadcast channels those have None for user_id:
-        if user_id is None:
-            user_id = subscriber.chat_name
-        user = UnknownUser(user_id)
-        raise e
+async def get_senders(messages):
+    """Get the senders of several messages by message id. See `get_sender`."""
+    senders = {}
+    for message in messages:
+        try:
+            senders[message.id] = await get_sender(message)
+        except BadMessageError:
+            # Ignore bad message errors
+            senders[message.id] = None
+
+    return senders
+
+
+async def process_message(
+    session,
+    subscriber,
+    message,
+    event,
+    user,
+    notices,
+    full_scan=False,
+    check_exists=True,
+):
+    """Process a single message of the given sender. Check if it has a file we want to download.
+
+    Returns a download job for the new file, if there is one.
+    The job may only be queued, after the file has been committed.
+    Nothing in here waits for telegram. Messages for the user are added to `notices`.
+    """
+    # Check if we should accept this message
+    if not should_accept_message(message, subscriber):
+        return None
+
+    # Create a new file. If it's not possible or not wanted, return None
+    with metrics.step_seconds.labels("create_file").time():
+        new_file = await create_file(
+            session, event, subscriber, message, user, full_scan, notices, check_exists
+        )
+    if new_file is None:
+        return None
+
+    # The file will be marked as succeeded by the download workers,
+    # as soon as it has been downloaded.
+    # Files of new messages are downloaded before those of scans.
+    return DownloadJob(message, new_file, SCAN if full_scan else LIVE)
 
 
 def main():
     """Login and start the bot."""
+    # Ensure save directory for files exists
+    if not os.path.exists(config["download"]["target_dir"]):
+        os.mkdir(config["download"]["target_dir"])
+
     if config["telegram"]["userbot"]:
         archive.start(phone=config["telegram"]["phone_number"])
     else:
         archive.start(bot_token=config["telegram"]["api_key"])
 
+    archive.loop.run_until_complete(subscriber_cache.preload())
+    # Pick up chats, which have been started on other shards.
+    refresh = archive.loop.create_task(
+        subscriber_cache.refresh(config["cache"]["subscriber_refresh"])
+    )
+    archive.loop.run_until_complete(entity_cache.get_me(archive))
+    download_queue.start(archive.loop)
+    metrics.start()
+    # Downloads, which were interrupted during the last run, are continued in the background.
+    recovery = archive.loop.create_task(recover_downloads(archive))
+    # E.g. remove directories, which were left in the trash during the last shutdown.
+    archive.loop.call_soon(storage.start)
     archive.run_until_disconnected()
+    recovery.cancel()
+    refresh.cancel()
+
+    # Close all pooled database connections.
+    archive.loop.run_until_complete(async_engine.dispose())
@@ -1,6 +1,6 @@
 """Config values for archivebot."""
+import copy
 import os
-import sys
 
 import toml
 
@@ -14,6 +14,21 @@ default_config = {
     },
     "database": {
         "sql_uri": "sqlite:///archivebot.db",
+        "pool_size": 5,
+    },
+    "storage": {
+        # Where the files are archived. Either "local" or "s3".
+        # With "s3", the target directory of the downloads only holds the volumes of /zip.
+        "backend": "local",
+        "s3_endpoint_url": "http://127.0.0.1:9000",
+        "s3_region": "",
+        "s3_bucket": "archivebot",
+        "s3_access_key": "",
+        "s3_secret_key": "",
+        # Prepended to the keys of all objects, e.g. "archive/".
+        "s3_prefix": "",
+        # Files are uploaded in parts of this size. S3 requires at least 5m.
+        "s3_part_size": "8m",
     },
     "logging": {
         "sentry_enabled": False,
@@ -22,28 +37,82 @@ default_config = {
     "download": {
         "allowed_types": ["document", "photo"],
         "target_dir": "/home/user/archivebot/",
+        "workers": 4,
+        "max_per_chat": 2,
+        "max_attempts": 5,
+        # Downloads found by /scan_chat may only use this many workers.
+        # The other workers are kept free for the files of new messages.
+        "scan_workers": 3,
+        # Scan downloads per second, globally and per chat. 0 disables the limit.
+        "scan_rate": 10,
+        "scan_rate_per_chat": 4,
+        # Seconds, for which scan downloads pause after a flood wait ended.
+        "scan_flood_pause": 60,
+        "deduplicate": False,
+        # Documents of at least this size are downloaded in chunks over several connections.
+        "chunked_min_size": "100m",
+        "chunked_connections": 4,
+        # The amount of directories, whose file names are kept in memory.
+        "name_index_size": 1000,
+        # Threads for file system operations, e.g. renaming or deleting chat directories.
+        "filesystem_workers": 8,
     },
     "zip": {
         "volume_size": "1400m",
     },
+    "cache": {
+        "entity_size": 10000,
+        "entity_ttl": 3600,
+        "entity_db": False,
+        # Seconds, after which the settings of all chats are reloaded from the database.
+        # This picks up changes of other bot processes, e.g. a `/start` on another shard.
+        "subscriber_refresh": 60,
+    },
+    "metrics": {
+        "enabled": False,
+        "address": "127.0.0.1",
+        "port": 9105,
+    },
+    "shard": {
+        # Every bot process, which shares the database, needs a name of its own.
+        "name": "default",
+        # Seconds, after which a download claimed by a dead process is free again.
+        "claim_timeout": 600,
+    },
 }
 
-config_path = os.path.expanduser("~/.config/archivebot.toml")
+# Several bot processes with different accounts need different config files.
+config_path = os.path.expanduser(
+    os.environ.get("ARCHIVEBOT_CONFIG", "~/.config/archivebot.toml")
+)
 
-if not os.path.exists(config_path):
-    with open(config_path, "w") as file_descriptor:
-        toml.dump(default_config, file_descriptor)
-    print("Please adjust the configuration file at '~/.config/archivebot.toml'")
-    sys.exit(1)
-else:
-    config = toml.load(config_path)
 
-    # Set default values for any missing keys in the loaded config
+def load_config(path):
+    """Load the config file and set default values for any missing keys."""
+    loaded = toml.load(path)
     for key, category in default_config.items():
-        if key not in config:
-            config[key] = category
+        if key not in loaded:
+            loaded[key] = copy.deepcopy(category)
             continue
 
         for option, value in category.items():
-            if option not in config[key]:
-                config[key][option] = value
+            if option not in loaded[key]:
+                loaded[key][option] = copy.deepcopy(value)
+
+    return loaded
+
+
+def create_default_config():
+    """Write the default config, so it can be adjusted by the user."""
+    os.makedirs(os.path.dirname(config_path), exist_ok=True)
+    with open(config_path, "w") as file_descriptor:
+        toml.dump(default_config, file_descriptor)
+
+
+# The command line creates the config, if it doesn't exist yet.
+# Importing this module has no side effects, the defaults are used in that case.
+config_exists = os.path.exists(config_path)
+if config_exists:
+    config = load_config(config_path)
+else:
+    config = copy.deepcopy(default_config)
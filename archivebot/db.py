@@ -1,16 +1,53 @@
-"""Helper class to create a database engine and to get a session."""
+"""Helper class to create a database engine and to get a session.
+
+The bot itself only uses the asyncio engine, so database calls never block the event loop.
+The synchronous engine is used by the command line for creating the schema.
+"""
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm.session import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from archivebot.config import config
+from archivebot.metrics import metrics
+
+# The asyncio drivers, which are used for the configured database.
+async_drivers = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def get_async_url(sql_uri):
+    """Get the database url with an asyncio driver."""
+    url = make_url(sql_uri)
+    if url.drivername in async_drivers:
+        url = url.set(drivername=async_drivers[url.drivername])
+
+    return url
+
 
 engine = create_engine(config["database"]["sql_uri"])
 base = declarative_base(bind=engine)
 
+async_engine = create_async_engine(
+    get_async_url(config["database"]["sql_uri"]),
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=config["database"]["pool_size"],
+)
+metrics.instrument_engine(async_engine.sync_engine)
+
+# A single session factory for the whole bot.
+# Objects stay usable after a commit, since reloading them would need an await.
+session_factory = sessionmaker(
+    async_engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+)
+
 
-def get_session(connection=None):
+def get_session():
     """Get a new db session."""
-    session = scoped_session(sessionmaker(bind=engine))
-    return session
+    return session_factory()
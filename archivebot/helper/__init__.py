@@ -1,6 +1,11 @@
 """Some static stuff or helper functions for archive bot."""
 from telethon import types
 
+from archivebot.helper.admission import is_admitted
+from archivebot.helper.cache import subscriber_cache
+from archivebot.helper.export import format_size, parse_size
+from archivebot.helper.shard import DEFAULT_SHARD, is_own_chat
+from archivebot.metrics import metrics
 from archivebot.models import Subscriber
 
 possible_media = ["document", "photo", "sticker"]
@@ -25,19 +30,23 @@ Available commands:
 /start Start the bot
 /stop Stop the bot
 /clear_history - Clear all files from the server.
-/zip Create a zip file of all files on the server
+/zip [new] Create a zip file of all files on the server. With `new`, only files since the last /zip are included.
 /set_name Set the name for this chat. This also determines the name of the target folder on the server.
-/scan_chat Scan the whole chat history for files to back up.
+/scan_chat Scan the whole chat history for files to back up. An interrupted scan continues where it stopped.
 /verbose [true, false] The bot will complain if there are duplicate files or uncompressed images are sent, whilst not being accepted.
 /sort_by_user [true, false] Incoming files will be sorted by user in the server directory for this chat.
 /accept [photo || document || sticker] Specify the allowed media types. Always provide a space separated list of all accepted media types, e.g. 'document photo'.
 /allow_duplicates [true, false] Allow to save files with duplicate names.
+/max_size [size, off] Skip files larger than this size, e.g. '/max_size 500m'.
+/quota [size, off] Stop archiving files, once this chat uses this much storage, e.g. '/quota 20g'.
+/allow_mime [patterns] Only archive files with these mime types, e.g. '/allow_mime image/* video/mp4'. Without patterns all mime types are allowed.
+/deny_mime [patterns] Never archive files with these mime types, e.g. '/deny_mime video/*'. Without patterns no mime type is denied.
 /info Show current settings.
 /help Show this text
 """
 
 
-def get_info_text(subscriber):
+def get_info_text(subscriber, process_filter):
     """Format the info text."""
     return f"""Current settings:
 
@@ -47,13 +56,22 @@ Accepted Media: {subscriber.accepted_media}
 Verbose: {subscriber.verbose}
 Allow duplicates: {subscriber.allow_duplicates}
 Sort files by User: {subscriber.sort_by_user}
+Shard: {subscriber.shard or DEFAULT_SHARD}
+Max file size: {format_optional_size(subscriber.max_file_size)}
+Allowed mime types: {subscriber.allowed_mime_types or "all"}
+Denied mime types: {subscriber.denied_mime_types or "none"}
+Used storage: {format_size(subscriber.used_bytes)} of {format_optional_size(subscriber.quota)}
+
+Dropped messages: {process_filter.dropped} of {process_filter.received}
 """
 
 
 async def get_option_for_subscriber(event, session):
     """Return the resolved option value and the subscriber for a command."""
     chat_id, chat_type = get_peer_information(event.message.to_id)
-    subscriber = Subscriber.get_or_create(session, chat_id, chat_type, event.message)
+    subscriber = await Subscriber.get_or_create(
+        session, chat_id, chat_type, event.message
+    )
 
     # Convert the incoming text into an boolean
     try:
@@ -67,10 +85,41 @@ async def get_option_for_subscriber(event, session):
     return subscriber, value
 
 
+async def get_size_option_for_subscriber(event, session):
+    """Return the resolved size option and the subscriber for a command.
+
+    `off` disables the limit, which is returned as None.
+    """
+    chat_id, chat_type = get_peer_information(event.message.to_id)
+    subscriber = await Subscriber.get_or_create(
+        session, chat_id, chat_type, event.message
+    )
+
+    try:
+        text = event.message.message.split(" ", maxsplit=1)[1].strip()
+        value = None if text.lower() == "off" else parse_size(text)
+    except Exception:
+        text = "Got an invalid size. Please use a size like 500m or 20g, or off."
+        await event.respond(text)
+
+        return None, None
+
+    return subscriber, value
+
+
+def format_optional_size(size):
+    """Format a size limit, which might be disabled."""
+    if size is None:
+        return "unlimited"
+
+    return format_size(size)
+
+
 def get_username(user):
     """Get a username from a user.
 
     Try to get any name first, fallback to id.
+    Users are already memoized with a TTL by the entity cache.
     """
     if user.username:
         return user.username
@@ -94,6 +143,18 @@ def get_peer_information(peer):
         raise Exception("Unknown chat type")
 
 
+def get_peer(chat_id, chat_type):
+    """Get the peer of a chat. This is the reverse of get_peer_information."""
+    if chat_type == "user":
+        return types.PeerUser(chat_id)
+    elif chat_type == "peer":
+        return types.PeerChat(chat_id)
+    elif chat_type == "channel":
+        return types.PeerChannel(chat_id)
+    else:
+        raise Exception("Unknown chat type")
+
+
 def get_bool_from_text(text):
     """Check if we can convert this string to bool."""
     if text.lower() in ["1", "true", "on"]:
@@ -104,22 +165,82 @@ def get_bool_from_text(text):
         raise Exception("Unknown boolean text")
 
 
-async def should_accept_message(event, message, user, subscriber):
-    """Check if we should accept this message."""
-    if subscriber.active is False:
-        return False
+def should_accept_message(message, subscriber):
+    """Check if we should accept this message.
 
+    This works with a subscriber as well as with cached subscriber settings.
+    It's cheap enough to be called for every single message.
+    """
     # No media => not interesting
     if message.media is None:
         return False
 
-    # We only want messages from users
-    if not isinstance(user, (types.User, UnknownUser)):
+    # There's no subscriber for this chat or it isn't active.
+    if subscriber is None or subscriber.active is False:
+        return False
+
+    # The chat is archived by another bot process.
+    if not is_own_chat(subscriber):
+        return False
+
+    # The file is too large or its mime type isn't wanted.
+    if not is_admitted(message, subscriber):
         return False
 
     return True
 
 
+class MessageFilter:
+    """Event filter for the catch-all message handler.
+
+    Messages without media or from chats without an active subscriber are dropped,
+    before the event even reaches the handler.
+    """
+
+    def __init__(self):
+        """Create a new filter."""
+        self.received = 0
+        self.dropped = 0
+
+    def __call__(self, event):
+        """Check whether the event should be passed to the handler."""
+        # Messages of albums are handled together by the album handler.
+        if event.message.grouped_id is not None:
+            return False
+
+        return self.check_message(event.message, "process")
+
+    def filter_album(self, event):
+        """Check whether any message of an album should be passed to the album handler."""
+        accepted = [
+            self.check_message(message, "process_album") for message in event.messages
+        ]
+        return any(accepted)
+
+    def check_message(self, message, handler):
+        """Check a single message and count it."""
+        self.received += 1
+
+        # Check the media first. This doesn't even need a cache lookup.
+        if message.media is not None:
+            try:
+                chat_id, chat_type = get_peer_information(message.to_id)
+            except Exception:
+                chat_id = None
+
+            if chat_id is not None and should_accept_message(
+                message, subscriber_cache.get(chat_id, chat_type)
+            ):
+                return True
+
+        self.dropped += 1
+        metrics.events.labels(handler, "dropped").inc()
+        return False
+
+
+process_filter = MessageFilter()
+
+
 class UnknownUser:
     """A helper class for messages from users which don't have a profile."""
 
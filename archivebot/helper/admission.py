@@ -0,0 +1,88 @@
+"""Per-chat rules, which decide whether a file is archived at all.
+
+All rules are checked with the metadata of a message, before a file is created
+or a single byte is downloaded. The storage used by a chat is tracked in
+an incrementally maintained counter of its subscriber.
+"""
+from fnmatch import fnmatch
+from functools import lru_cache
+
+from sqlalchemy import or_, update
+
+from archivebot.models import Subscriber
+
+
+@lru_cache(maxsize=None)
+def parse_mime_types(mime_types):
+    """Convert a space separated list of mime type patterns into a tuple."""
+    return tuple(mime_types.split())
+
+
+def get_media_info(message):
+    """Get the size and the mime type of the media of a message."""
+    media = message.file
+    if media is None:
+        return None, None
+
+    return media.size, media.mime_type
+
+
+def matches_mime_type(mime_type, patterns):
+    """Check whether a mime type matches any pattern like `video/*`."""
+    return any(fnmatch(mime_type or "", pattern) for pattern in patterns)
+
+
+def is_admitted(message, subscriber):
+    """Check the size and mime type rules of a subscriber.
+
+    This works with a subscriber as well as with cached subscriber settings.
+    """
+    size, mime_type = get_media_info(message)
+
+    max_file_size = subscriber.max_file_size
+    if max_file_size is not None and size is not None and size > max_file_size:
+        return False
+
+    allowed = parse_mime_types(subscriber.allowed_mime_types)
+    if allowed and not matches_mime_type(mime_type, allowed):
+        return False
+
+    denied = parse_mime_types(subscriber.denied_mime_types)
+    if denied and matches_mime_type(mime_type, denied):
+        return False
+
+    return True
+
+
+async def reserve_quota(session, subscriber, size):
+    """Add the size of a new file to the storage used by a chat.
+
+    The check and the increment are a single statement, so concurrent
+    events can't exceed the quota together. Returns whether the file fits.
+    """
+    result = await session.execute(
+        update(Subscriber)
+        .where(Subscriber.chat_id == subscriber.chat_id)
+        .where(Subscriber.chat_type == subscriber.chat_type)
+        .where(
+            or_(
+                Subscriber.quota.is_(None),
+                Subscriber.used_bytes + size <= Subscriber.quota,
+            )
+        )
+        .values(used_bytes=Subscriber.used_bytes + size)
+        .execution_options(synchronize_session=False)
+    )
+
+    return result.rowcount == 1
+
+
+async def release_quota(session, chat_id, chat_type, size):
+    """Subtract the size of a removed file from the storage used by a chat."""
+    await session.execute(
+        update(Subscriber)
+        .where(Subscriber.chat_id == chat_id)
+        .where(Subscriber.chat_type == chat_type)
+        .values(used_bytes=Subscriber.used_bytes - size)
+        .execution_options(synchronize_session=False)
+    )
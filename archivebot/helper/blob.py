@@ -0,0 +1,203 @@
+"""Content-addressed blob store for deduplicating files across chats.
+
+Each file is stored once under its sha256 hash in the blob directory.
+The files in the chat directories are hardlinks to these blobs.
+"""
+import hashlib
+import os
+import shutil
+import uuid
+
+from sqlalchemy import delete, exists, select
+
+from archivebot.config import config
+from archivebot.db import get_session
+from archivebot.helper.file import add_extension
+from archivebot.helper.filesystem import filesystem
+from archivebot.metrics import metrics
+from archivebot.models import Blob, File
+from archivebot.sentry import sentry
+
+# The size of the blocks, in which existing files are hashed.
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def get_blob_dir():
+    """Get the directory of the blob store."""
+    return os.path.join(config["download"]["target_dir"], ".blobs")
+
+
+def get_blob_path(sha256):
+    """Get the path of a blob. Blobs are spread over subdirectories by their prefix."""
+    return os.path.join(get_blob_dir(), sha256[:2], sha256)
+
+
+class HashingWriter:
+    """File-like object, which hashes all data while writing it to a file."""
+
+    def __init__(self, file_descriptor):
+        """Create a new writer for an open file."""
+        self.file_descriptor = file_descriptor
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        """Write and hash a chunk of data."""
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file_descriptor.write(data)
+
+    def tell(self):
+        """Return the amount of written bytes."""
+        return self.size
+
+    def flush(self):
+        """Flush the underlying file."""
+        self.file_descriptor.flush()
+
+
+def hash_file(path):
+    """Get the sha256 hash and the size of a file."""
+    file_hash = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as file_descriptor:
+        while block := file_descriptor.read(HASH_BLOCK_SIZE):
+            file_hash.update(block)
+            size += len(block)
+
+    return file_hash.hexdigest(), size
+
+
+def link_blob(blob_path, file_path):
+    """Link a blob into a chat directory.
+
+    Hardlinks only work on the same file system. Fall back to copying otherwise.
+    This blocks and is only called from the file system threads.
+    """
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+    try:
+        os.link(blob_path, file_path)
+    except OSError:
+        # Every copy takes the full space again. This is most likely a misconfiguration.
+        metrics.blob_copies.inc()
+        sentry.captureMessage(
+            "Blob couldn't be hardlinked and has been copied",
+            extra={"blob_path": blob_path, "file_path": file_path},
+        )
+        shutil.copyfile(blob_path, file_path)
+
+
+async def link_known_blob(media_id, file_path):
+    """Link the content of a media, if it's already in the blob store.
+
+    Returns whether the media has been known.
+    """
+    async with get_session() as session:
+        blob = await session.get(Blob, media_id)
+    if blob is None or not await filesystem.exists(get_blob_path(blob.sha256)):
+        return False
+
+    await filesystem.run(link_blob, get_blob_path(blob.sha256), file_path)
+    return True
+
+
+def store_blob(path, blob_path):
+    """Move a file to its blob path, unless somebody else already uploaded the same content."""
+    if not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(path, blob_path)
+
+
+async def add_blob(media_id, path, sha256, size):
+    """Move a downloaded file into the blob store and register its media id.
+
+    Returns the path of the blob.
+    """
+    blob_path = get_blob_path(sha256)
+    await filesystem.run(store_blob, path, blob_path)
+
+    async with get_session() as session:
+        await session.merge(Blob(media_id, sha256, size))
+        await session.commit()
+
+    return blob_path
+
+
+def delete_unreferenced_blobs(session):
+    """Delete all blobs, whose media isn't referenced by any file anymore.
+
+    Takes a synchronous session. Content, that's still used by another media id, is kept.
+    Returns the sha256 hashes and sizes of the blob files, which can be removed.
+    """
+    unreferenced = ~exists().where(File.file_id == Blob.media_id)
+    result = session.execute(select(Blob.sha256, Blob.size).where(unreferenced))
+    blobs = dict(result.all())
+    if len(blobs) == 0:
+        return {}
+
+    session.execute(
+        delete(Blob).where(unreferenced).execution_options(synchronize_session=False)
+    )
+    result = session.execute(select(Blob.sha256).where(Blob.sha256.in_(blobs)))
+    for (sha256,) in result:
+        del blobs[sha256]
+
+    return blobs
+
+
+def remove_blob_files(blobs):
+    """Remove the files of the given blobs. Returns the amount of freed bytes.
+
+    Blobs are only removed after their rows have been deleted. Blobs, which have
+    just been stored, but aren't registered yet, are never touched.
+    """
+    freed = 0
+    for sha256, size in blobs.items():
+        try:
+            os.remove(get_blob_path(sha256))
+        except FileNotFoundError:
+            continue
+        freed += size
+
+    return freed
+
+
+async def deduplicate_file(media_id, file_path):
+    """Move an already downloaded file into the blob store and link it back."""
+    sha256, size = await filesystem.run(hash_file, file_path)
+    blob_path = await add_blob(media_id, file_path, sha256, size)
+    await filesystem.run(link_blob, blob_path, file_path)
+
+
+async def download_deduplicated(message, media_id, file_path):
+    """Download the media of a message into the blob store and link it to the file path.
+
+    If the content of this media is already known, the download is skipped completely.
+    Returns the path of the linked file or None, if the download failed.
+    """
+    file_path = add_extension(message, file_path)
+    if await link_known_blob(media_id, file_path):
+        return file_path
+
+    # Download into a temporary file and hash the content while streaming.
+    temp_dir = os.path.join(get_blob_dir(), "tmp")
+    await filesystem.makedirs(temp_dir)
+    temp_path = os.path.join(temp_dir, uuid.uuid4().hex)
+    try:
+        with open(temp_path, "wb") as file_descriptor:
+            writer = HashingWriter(file_descriptor)
+            result = await message.download_media(writer)
+        if result is None:
+            return None
+
+        blob_path = await add_blob(
+            media_id, temp_path, writer.hash.hexdigest(), writer.size
+        )
+    finally:
+        if await filesystem.exists(temp_path):
+            await filesystem.remove(temp_path)
+
+    await filesystem.run(link_blob, blob_path, file_path)
+    return file_path
@@ -0,0 +1,190 @@
+"""In-memory caches, which save us database and network round-trips on hot paths."""
+import asyncio
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from sqlalchemy import select
+from telethon import types, utils
+
+from archivebot.config import config
+from archivebot.db import get_session
+from archivebot.metrics import metrics
+from archivebot.models import CachedUser, Subscriber
+from archivebot.sentry import sentry
+
+
+@lru_cache(maxsize=None)
+def parse_accepted_media(accepted_media):
+    """Convert the accepted_media string of a subscriber into a set."""
+    return frozenset(accepted_media.split(" "))
+
+
+class SubscriberSettings:
+    """A snapshot of the settings of a subscriber, which is detached from any session."""
+
+    def __init__(self, subscriber):
+        """Copy the settings from a subscriber."""
+        self.chat_name = subscriber.chat_name
+        self.active = subscriber.active
+        self.accepted_media = parse_accepted_media(subscriber.accepted_media)
+        self.verbose = subscriber.verbose
+        self.allow_duplicates = subscriber.allow_duplicates
+        self.sort_by_user = subscriber.sort_by_user
+        self.shard = subscriber.shard
+        self.max_file_size = subscriber.max_file_size
+        self.allowed_mime_types = subscriber.allowed_mime_types
+        self.denied_mime_types = subscriber.denied_mime_types
+
+
+class SubscriberCache:
+    """Write-through cache for subscriber settings, keyed by (chat_id, chat_type).
+
+    The settings of all subscribers are preloaded on startup and reloaded periodically,
+    since other bot processes might change them as well.
+    Afterwards, any chat that isn't in the cache is known to have no subscriber.
+    Every command that changes a subscriber has to call `update` with the changed subscriber.
+    """
+
+    def __init__(self):
+        """Create a new empty cache."""
+        self.settings = {}
+        # Chats, which have been updated while the settings are being reloaded.
+        self.changed = set()
+
+    async def preload(self):
+        """Load the settings of all subscribers with a single query."""
+        self.changed = set()
+        async with get_session() as session:
+            result = await session.execute(select(Subscriber))
+            settings = {
+                (subscriber.chat_id, subscriber.chat_type): SubscriberSettings(
+                    subscriber
+                )
+                for subscriber in result.scalars()
+            }
+
+        # Don't overwrite updates, which happened during the query, with older settings.
+        for key in self.changed:
+            settings[key] = self.settings[key]
+        self.settings = settings
+
+    async def refresh(self, interval):
+        """Reload the settings of all subscribers every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.preload()
+            except Exception:
+                traceback.print_exc()
+                sentry.captureException()
+
+    def get(self, chat_id, chat_type):
+        """Get the settings of a chat. Returns None, if there's no subscriber."""
+        return self.settings.get((chat_id, chat_type))
+
+    def update(self, subscriber):
+        """Replace the cached settings with those of the given subscriber."""
+        key = (subscriber.chat_id, subscriber.chat_type)
+        self.settings[key] = SubscriberSettings(subscriber)
+        self.changed.add(key)
+
+
+class EntityCache:
+    """LRU cache with a TTL for resolved telegram entities.
+
+    If `use_db` is set, users are additionally persisted in the database.
+    That way they can be resolved without network requests, even after a restart.
+    """
+
+    def __init__(self, size, ttl, use_db):
+        """Create a new empty cache."""
+        self.size = size
+        self.ttl = ttl
+        self.use_db = use_db
+
+        # Maps peer ids to (expiry timestamp, entity) tuples.
+        # The order of the keys is the LRU order.
+        self.entities = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.me = None
+
+    async def get_me(self, client):
+        """Get our own user. This is only resolved once."""
+        if self.me is None:
+            self.me = await client.get_me()
+
+        return self.me
+
+    async def get_entity(self, client, peer):
+        """Resolve a peer from the cache, the database or telegram, in that order."""
+        peer_id = utils.get_peer_id(peer)
+
+        entry = self.entities.get(peer_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entities.move_to_end(peer_id)
+            self.hits += 1
+            metrics.entity_lookups.labels("memory").inc()
+            return entry[1]
+
+        self.misses += 1
+        entity = None
+        if self.use_db and peer_id > 0:
+            entity = await self.load_user(peer_id)
+            if entity is not None:
+                metrics.entity_lookups.labels("database").inc()
+
+        if entity is None:
+            metrics.entity_lookups.labels("network").inc()
+            entity = await client.get_entity(peer)
+            if self.use_db and isinstance(entity, types.User):
+                await self.save_user(entity)
+
+        self.add(peer_id, entity)
+
+        return entity
+
+    def add(self, peer_id, entity):
+        """Add an entity and evict the least recently used ones, if we're full."""
+        self.entities[peer_id] = (time.monotonic() + self.ttl, entity)
+        self.entities.move_to_end(peer_id)
+        while len(self.entities) > self.size:
+            self.entities.popitem(last=False)
+
+    async def load_user(self, user_id):
+        """Load a user from the database, unless it's outdated."""
+        async with get_session() as session:
+            cached_user = await session.get(CachedUser, user_id)
+            if (
+                cached_user is None
+                or cached_user.updated_at < datetime.now() - timedelta(seconds=self.ttl)
+            ):
+                return None
+
+            return types.User(
+                id=cached_user.id,
+                username=cached_user.username,
+                first_name=cached_user.first_name,
+                last_name=cached_user.last_name,
+            )
+
+    async def save_user(self, user):
+        """Persist a user in the database."""
+        async with get_session() as session:
+            cached_user = await session.get(CachedUser, user.id)
+            if cached_user is None:
+                session.add(CachedUser(user))
+            else:
+                cached_user.update(user)
+            await session.commit()
+
+
+subscriber_cache = SubscriberCache()
+entity_cache = EntityCache(
+    config["cache"]["entity_size"],
+    config["cache"]["entity_ttl"],
+    config["cache"]["entity_db"],
+)
@@ -0,0 +1,169 @@
+"""Download large documents in chunks over several concurrent requests.
+
+The chunks are interleaved between the connections. Connection `n` out of `N`
+fetches the chunks `n`, `n + N`, `n + 2N`, ... and writes them into a preallocated file.
+Thereby all chunks up to some offset are complete at nearly any time.
+This offset is stored in the database, so an interrupted download can be resumed.
+"""
+import asyncio
+import math
+import os
+
+from archivebot.config import config
+from archivebot.db import get_session
+from archivebot.helper.export import parse_size
+from archivebot.helper.file import add_extension
+from archivebot.helper.filesystem import filesystem
+from archivebot.models.file import File
+
+# Telegram doesn't allow requests larger than 512kb.
+CHUNK_SIZE = 512 * 1024
+# Store the offset of a download, whenever this many further chunks are complete.
+PROGRESS_CHUNKS = 64
+
+
+def should_download_chunked(message):
+    """Check whether the media of a message is large enough for a chunked download."""
+    if message.document is None:
+        return False
+
+    return message.document.size >= parse_size(config["download"]["chunked_min_size"])
+
+
+def preallocate(file_descriptor, size):
+    """Reserve the disk space for a file. Fall back to a sparse file if necessary."""
+    try:
+        os.posix_fallocate(file_descriptor, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(file_descriptor, size)
+
+
+async def get_file_offset(file_key):
+    """Get the offset, up to which a file has been downloaded."""
+    async with get_session() as session:
+        known_file = await session.get(File, file_key)
+        if known_file is None:
+            return 0
+
+        return known_file.download_offset
+
+
+async def set_file_offset(file_key, offset):
+    """Persist the offset, up to which a file has been downloaded."""
+    async with get_session() as session:
+        known_file = await session.get(File, file_key)
+        if known_file is not None:
+            known_file.download_offset = offset
+        await session.commit()
+
+
+class ChunkedDownload:
+    """A single chunked download of a document into a file."""
+
+    def __init__(self, job, connections):
+        """Create a new download for a job."""
+        self.job = job
+        self.connections = connections
+        self.document = job.message.document
+        self.chunk_count = math.ceil(self.document.size / CHUNK_SIZE)
+
+        # The first chunk, which isn't completely written yet.
+        self.next_chunk = 0
+        # Finished chunks behind `next_chunk`.
+        self.finished = set()
+        self.stored_chunk = 0
+        # The offset is written by all connections. Keep the writes in order.
+        self.store_lock = asyncio.Lock()
+
+    async def run(self, file_descriptor, offset):
+        """Download all chunks after the given offset."""
+        self.next_chunk = self.stored_chunk = offset // CHUNK_SIZE
+        remaining = self.chunk_count - self.next_chunk
+        connections = max(1, min(self.connections, remaining))
+
+        tasks = [
+            asyncio.create_task(
+                self.fetch(file_descriptor, self.next_chunk + index, connections)
+            )
+            for index in range(connections)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            await self.store_offset(force=True)
+
+    async def fetch(self, file_descriptor, first_chunk, stride):
+        """Fetch every `stride`th chunk starting at `first_chunk`."""
+        chunks = range(first_chunk, self.chunk_count, stride)
+        if len(chunks) == 0:
+            return
+
+        chunk = first_chunk
+        async for data in self.job.message.client.iter_download(
+            self.document,
+            offset=first_chunk * CHUNK_SIZE,
+            stride=stride * CHUNK_SIZE,
+            limit=len(chunks),
+            request_size=CHUNK_SIZE,
+            file_size=self.document.size,
+        ):
+            await filesystem.run(os.pwrite, file_descriptor, data, chunk * CHUNK_SIZE)
+            self.finish_chunk(chunk)
+            chunk += stride
+            await self.store_offset()
+
+    def finish_chunk(self, chunk):
+        """Mark a chunk as written and advance the complete part of the file."""
+        self.finished.add(chunk)
+        while self.next_chunk in self.finished:
+            self.finished.remove(self.next_chunk)
+            self.next_chunk += 1
+
+    async def store_offset(self, force=False):
+        """Persist the complete part of the file from time to time."""
+        if self.next_chunk == self.stored_chunk:
+            return
+        if not force and self.next_chunk - self.stored_chunk < PROGRESS_CHUNKS:
+            return
+
+        async with self.store_lock:
+            if self.next_chunk <= self.stored_chunk:
+                return
+
+            self.stored_chunk = self.next_chunk
+            offset = min(self.next_chunk * CHUNK_SIZE, self.document.size)
+            await set_file_offset(self.job.file_key, offset)
+
+
+async def download_chunked(job):
+    """Download the document of a job in chunks and return the path of the file.
+
+    The data is written into a `.part` file, which is renamed once it's complete.
+    If the job has been interrupted before, the download continues at the stored offset.
+    """
+    file_path = add_extension(job.message, str(job.file_path))
+    part_path = f"{file_path}.part"
+
+    offset = await get_file_offset(job.file_key)
+    if not await filesystem.exists(part_path):
+        offset = 0
+
+    file_descriptor = await filesystem.run(os.open, part_path, os.O_RDWR | os.O_CREAT)
+    try:
+        if offset == 0:
+            await filesystem.run(
+                preallocate, file_descriptor, job.message.document.size
+            )
+
+        download = ChunkedDownload(job, config["download"]["chunked_connections"])
+        await download.run(file_descriptor, offset)
+    finally:
+        await filesystem.run(os.close, file_descriptor)
+
+    await filesystem.run(os.replace, part_path, file_path)
+    return file_path
@@ -0,0 +1,469 @@
+"""Download queue and workers for archiving files in the background."""
+import asyncio
+import time
+import traceback
+from datetime import datetime
+
+from telethon.errors import BadMessageError, FloodWaitError
+
+from archivebot.config import config
+from archivebot.db import get_session
+from archivebot.helper.admission import release_quota
+from archivebot.helper.blob import (
+    deduplicate_file,
+    download_deduplicated,
+    link_known_blob,
+)
+from archivebot.helper.chunked import download_chunked, should_download_chunked
+from archivebot.helper.file import add_extension
+from archivebot.helper.retry import flood_gate, get_backoff
+from archivebot.helper.scheduler import LIVE, SCAN, ChatQueue, RateLimiter
+from archivebot.helper.shard import FileClaim
+from archivebot.metrics import metrics
+from archivebot.models.file import File
+from archivebot.sentry import sentry
+from archivebot.storage import storage
+
+
+class DownloadJob:
+    """A single file, that has been registered in the database and waits for its download."""
+
+    def __init__(self, message, new_file, priority=LIVE):
+        """Create a new download job. The file needs to be flushed already."""
+        self.chat_key = (new_file.subscriber_chat_id, new_file.subscriber_chat_type)
+        self.file_key = (new_file.message_id, new_file.to_id, new_file.from_id)
+        self.file_id = new_file.file_id
+        self.file_path = new_file.file_path
+        self.attempts = new_file.attempts
+        self.message = message
+        # Either LIVE or SCAN. Live jobs are always downloaded first.
+        self.priority = priority
+        # The generation of the chat in the queue. See `DownloadQueue.discard`.
+        self.generation = None
+        # Whether the job waits for a retry.
+        self.scheduled = False
+
+        # Flood waits of file downloads only affect the data center of the file.
+        media = message.document or message.photo
+        self.dc_id = getattr(media, "dc_id", None)
+
+
+class DownloadQueue:
+    """A fair priority queue for downloads, which is drained by a fixed amount of workers.
+
+    Files of new messages are always downloaded before files found by scans.
+    Within each priority, jobs are grouped by chat and the chats are served round-robin.
+    That way a single chat with a burst of large files cannot starve all other chats.
+
+    The number of workers is the global cap for concurrent downloads.
+    `max_per_chat` limits, how many of those may be used by a single chat at once.
+    Scan downloads may only use `scan_workers` of them, so new messages always find a free worker.
+    They are also rate-limited globally and per chat, and pause after flood waits.
+    """
+
+    def __init__(
+        self,
+        workers,
+        max_per_chat,
+        max_attempts,
+        scan_workers,
+        scan_rate,
+        scan_rate_per_chat,
+        scan_flood_pause,
+    ):
+        """Create a new download queue."""
+        self.workers = workers
+        self.max_per_chat = max_per_chat
+        self.max_attempts = max_attempts
+        self.scan_workers = scan_workers
+        self.scan_rate_per_chat = scan_rate_per_chat
+        self.scan_flood_pause = scan_flood_pause
+
+        # Pending jobs by priority.
+        self.pending = {LIVE: ChatQueue(), SCAN: ChatQueue()}
+        # Amount of currently running downloads by chat.
+        self.running = {}
+        # Amount of currently running scan downloads.
+        self.running_scans = 0
+        # Rate limits of scan downloads. Disabled, if the rate isn't positive.
+        self.scan_limiter = None
+        if scan_rate > 0:
+            self.scan_limiter = RateLimiter(scan_rate, scan_rate)
+        self.chat_limiters = {}
+        # Amount of jobs by chat, which are scheduled to be queued again later.
+        self.scheduled = {}
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        # Futures of coroutines, that wait for all jobs of a chat to finish.
+        self.waiters = {}
+        # The generation of each chat is increased, whenever its jobs are discarded.
+        self.generations = {}
+        # The keys of all files, which are pending, running or scheduled.
+        self.file_keys = set()
+        # Limits, priorities and futures of coroutines, that wait for the queue to shrink.
+        self.capacity_waiters = []
+
+    def start(self, loop):
+        """Spawn the worker tasks on the given event loop."""
+        for _ in range(self.workers):
+            self.tasks.append(loop.create_task(self.worker()))
+
+    def put(self, job):
+        """Add a new job to the queue."""
+        if job.generation is None:
+            job.generation = self.generations.get(job.chat_key, 0)
+
+        self.file_keys.add(job.file_key)
+        self.pending[job.priority].put(job)
+        self.wakeup.set()
+
+    def discard(self, chat_key):
+        """Drop all pending jobs of a chat.
+
+        Scheduled retries of the chat are dropped as soon as they're due.
+        """
+        self.generations[chat_key] = self.generations.get(chat_key, 0) + 1
+        for queue in self.pending.values():
+            for job in queue.discard(chat_key):
+                self.file_keys.discard(job.file_key)
+        self.notify_capacity()
+
+        if not self.is_busy(chat_key):
+            for future in self.waiters.pop(chat_key, []):
+                if not future.done():
+                    future.set_result(None)
+
+    def is_discarded(self, job):
+        """Check whether a job has been discarded after it was queued."""
+        return job.generation != self.generations.get(job.chat_key, 0)
+
+    def is_queued(self, file_key):
+        """Check whether a file is pending, running or scheduled for a retry."""
+        return file_key in self.file_keys
+
+    def qsize(self, priority=None):
+        """Return the amount of jobs, that are waiting for a worker."""
+        if priority is not None:
+            return len(self.pending[priority])
+
+        return sum(len(queue) for queue in self.pending.values())
+
+    def is_busy(self, chat_key):
+        """Check whether there are any pending or running jobs for a chat."""
+        return (
+            any(chat_key in queue for queue in self.pending.values())
+            or chat_key in self.running
+            or chat_key in self.scheduled
+        )
+
+    async def join(self, chat_key):
+        """Wait until all jobs of a chat have been processed."""
+        if not self.is_busy(chat_key):
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(chat_key, []).append(future)
+        await future
+
+    async def wait_for_capacity(self, limit, priority=None):
+        """Wait until less than `limit` jobs of a priority are waiting for a worker."""
+        if self.qsize(priority) < limit:
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.capacity_waiters.append((limit, priority, future))
+        await future
+
+    def notify_capacity(self):
+        """Wake up all coroutines, which are waiting for the queue to shrink."""
+        waiting = []
+        for limit, priority, future in self.capacity_waiters:
+            if future.done():
+                continue
+            if self.qsize(priority) < limit:
+                future.set_result(None)
+            else:
+                waiting.append((limit, priority, future))
+
+        self.capacity_waiters = waiting
+
+    def get_chat_limiter(self, chat_key):
+        """Get the rate limiter for the scan downloads of a chat."""
+        limiter = self.chat_limiters.get(chat_key)
+        if limiter is None:
+            limiter = RateLimiter(self.scan_rate_per_chat, self.scan_rate_per_chat)
+            self.chat_limiters[chat_key] = limiter
+
+        return limiter
+
+    def get_scan_delay(self):
+        """Get the seconds until the next scan download may start, regardless of its chat.
+
+        Returns None, if scans are waiting for a running scan download to finish.
+        """
+        if self.running_scans >= self.scan_workers:
+            return None
+
+        delay = flood_gate.get_pause(self.scan_flood_pause)
+        if self.scan_limiter is not None:
+            delay = max(delay, self.scan_limiter.get_delay())
+
+        return delay
+
+    def is_chat_ready(self, chat_key):
+        """Check whether a chat may start another download."""
+        return self.running.get(chat_key, 0) < self.max_per_chat
+
+    def is_scan_chat_ready(self, chat_key):
+        """Check whether a chat may start another scan download."""
+        if not self.is_chat_ready(chat_key):
+            return False
+
+        if self.scan_rate_per_chat > 0:
+            return self.get_chat_limiter(chat_key).get_delay() == 0
+
+        return True
+
+    def pop(self):
+        """Get the next job, that may be started right now.
+
+        Returns the job or None and the seconds, after which another try might succeed.
+        """
+        job = self.pending[LIVE].pop(self.is_chat_ready)
+        if job is not None:
+            return job, None
+
+        if len(self.pending[SCAN]) == 0:
+            return None, None
+
+        delay = self.get_scan_delay()
+        if delay is None or delay > 0:
+            return None, delay
+
+        job = self.pending[SCAN].pop(self.is_scan_chat_ready)
+        if job is None:
+            # All chats with scans are either busy or rate-limited.
+            delays = [
+                self.get_chat_limiter(chat_key).get_delay()
+                for chat_key in self.pending[SCAN].jobs
+                if self.is_chat_ready(chat_key) and self.scan_rate_per_chat > 0
+            ]
+            return None, min(delays, default=None)
+
+        if self.scan_limiter is not None:
+            self.scan_limiter.take()
+        if self.scan_rate_per_chat > 0:
+            self.get_chat_limiter(job.chat_key).take()
+        self.running_scans += 1
+
+        return job, None
+
+    async def get(self):
+        """Get the next job of the highest priority, which may be started."""
+        while True:
+            job, delay = self.pop()
+            if job is not None:
+                self.running[job.chat_key] = self.running.get(job.chat_key, 0) + 1
+                self.notify_capacity()
+                return job
+
+            # Wait for new jobs, finished jobs or the end of a rate limit.
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self, job):
+        """Mark a job as finished and free its chat slot."""
+        self.running[job.chat_key] -= 1
+        if self.running[job.chat_key] == 0:
+            del self.running[job.chat_key]
+        if job.priority == SCAN:
+            self.running_scans -= 1
+
+        if not job.scheduled:
+            self.file_keys.discard(job.file_key)
+
+        if not self.is_busy(job.chat_key):
+            for future in self.waiters.pop(job.chat_key, []):
+                if not future.done():
+                    future.set_result(None)
+
+        # Chats might have been blocked by the per-chat limit.
+        self.wakeup.set()
+
+    def schedule(self, job, delay):
+        """Queue a job again after the given amount of seconds."""
+        self.scheduled[job.chat_key] = self.scheduled.get(job.chat_key, 0) + 1
+        job.scheduled = True
+        asyncio.get_running_loop().call_later(delay, self.resume, job)
+
+    def resume(self, job):
+        """Queue a scheduled job again."""
+        self.scheduled[job.chat_key] -= 1
+        if self.scheduled[job.chat_key] == 0:
+            del self.scheduled[job.chat_key]
+        job.scheduled = False
+        self.put(job)
+
+    async def retry(self, job, delay):
+        """Schedule a retry of a failed job, unless it failed too often."""
+        job.attempts += 1
+        if job.attempts >= self.max_attempts:
+            sentry.captureMessage(
+                "Giving up on download",
+                extra={"file_path": job.file_path, "attempts": job.attempts},
+                tags={"level": "info"},
+            )
+            await self.give_up(job)
+            return
+
+        await set_file_attempts(job.file_key, job.attempts)
+        self.schedule(job, delay)
+
+    async def give_up(self, job):
+        """Stop downloading a file for good.
+
+        The file keeps its entry, so it isn't archived again by the next scan.
+        Its size no longer counts towards the quota and its reserved name is freed.
+        """
+        async with get_session() as session:
+            known_file = await session.get(File, job.file_key)
+            # The quota has already been released, if the file has been given up before.
+            if known_file is not None and known_file.attempts < self.max_attempts:
+                known_file.attempts = self.max_attempts
+                await release_quota(
+                    session,
+                    known_file.subscriber_chat_id,
+                    known_file.subscriber_chat_type,
+                    known_file.size or 0,
+                )
+            await session.commit()
+
+        await storage.release(str(job.file_path))
+
+    async def process(self, job):
+        """Download the file of a job and schedule a retry, if that fails temporarily."""
+        # The jobs of this chat have been discarded in the meantime.
+        if self.is_discarded(job):
+            return
+
+        # Don't block a worker, while the data center of this file is flood-gated.
+        delay = flood_gate.get_delay(job.dc_id)
+        if delay > 0:
+            self.schedule(job, delay)
+            return
+
+        # Another bot process on the same database is downloading this file already.
+        claim = FileClaim(job.file_key)
+        if not await claim.acquire():
+            metrics.downloads.labels("claimed").inc()
+            return
+
+        try:
+            # The media can't be downloaded at all. Retrying won't help.
+            if not await download_file(job):
+                await self.give_up(job)
+        except FloodWaitError as e:
+            metrics.downloads.labels("flood_wait").inc()
+            flood_gate.block(e.seconds + 1, job.dc_id)
+            await self.retry(job, e.seconds + 1)
+        except (TimeoutError, asyncio.TimeoutError):
+            metrics.downloads.labels("timeout").inc()
+            await self.retry(job, get_backoff(job.attempts))
+        finally:
+            await claim.release()
+
+    async def worker(self):
+        """Download files until the bot is shut down."""
+        while True:
+            job = await self.get()
+            try:
+                await self.process(job)
+            except BadMessageError:
+                # Ignore bad message errors
+                pass
+            except Exception:
+                # The files of a discarded job are removed while it's running.
+                if not self.is_discarded(job):
+                    traceback.print_exc()
+                    sentry.captureException()
+            finally:
+                self.done(job)
+
+
+async def download_large_file(job):
+    """Download a large document in chunks and return the path of the file."""
+    deduplicate = config["download"]["deduplicate"]
+    if deduplicate:
+        file_path = add_extension(job.message, str(job.file_path))
+        if await link_known_blob(job.file_id, file_path):
+            return file_path
+
+    file_path = await download_chunked(job)
+    if deduplicate:
+        await deduplicate_file(job.file_id, file_path)
+
+    return file_path
+
+
+async def download_file(job):
+    """Download the file of a job and mark it as succeeded.
+
+    Returns whether the download succeeded.
+    """
+    start = time.perf_counter()
+    # Remote backends stream the media into the storage by themselves.
+    if not storage.is_local:
+        success = await storage.download(job)
+    elif should_download_chunked(job.message):
+        success = await download_large_file(job)
+    elif config["download"]["deduplicate"]:
+        success = await download_deduplicated(
+            job.message, job.file_id, str(job.file_path)
+        )
+    else:
+        success = await job.message.download_media(str(job.file_path))
+
+    # Download succeeded, if the result is not None
+    if success is None:
+        metrics.downloads.labels("failed").inc()
+        return False
+
+    metrics.downloads.labels("success").inc()
+    metrics.download_seconds.observe(time.perf_counter() - start)
+    metrics.download_bytes.inc(await storage.get_size(success))
+
+    async with get_session() as session:
+        known_file = await session.get(File, job.file_key)
+        if known_file is not None:
+            known_file.success = True
+            known_file.downloaded_at = datetime.now()
+            # Telethon might have added a file extension.
+            known_file.file_path = str(success)
+        await session.commit()
+
+    return True
+
+
+async def set_file_attempts(file_key, attempts):
+    """Persist the amount of failed attempts, so retries survive a restart."""
+    async with get_session() as session:
+        known_file = await session.get(File, file_key)
+        if known_file is not None:
+            known_file.attempts = attempts
+        await session.commit()
+
+
+download_queue = DownloadQueue(
+    config["download"]["workers"],
+    config["download"]["max_per_chat"],
+    config["download"]["max_attempts"],
+    config["download"]["scan_workers"],
+    config["download"]["scan_rate"],
+    config["download"]["scan_rate_per_chat"],
+    config["download"]["scan_flood_pause"],
+)
+metrics.queue_depth.set_function(download_queue.qsize)
+metrics.downloads_running.set_function(lambda: sum(download_queue.running.values()))
@@ -0,0 +1,169 @@
+"""Helper for exporting the files of a chat as archive volumes."""
+import asyncio
+import os
+import tarfile
+import threading
+
+from archivebot.helper.filesystem import filesystem
+
+size_units = {
+    "b": 1,
+    "k": 1024,
+    "m": 1024**2,
+    "g": 1024**3,
+}
+
+
+def parse_size(text):
+    """Parse a 7z style size string like "1400m" into bytes."""
+    text = str(text).strip().lower()
+    if text[-1] in size_units:
+        return int(text[:-1]) * size_units[text[-1]]
+
+    return int(text)
+
+
+def format_size(size):
+    """Format a size in bytes with the largest fitting unit, e.g. "1.5g"."""
+    for unit in ["g", "m", "k"]:
+        if size >= size_units[unit]:
+            return f"{size / size_units[unit]:.1f}{unit}"
+
+    return f"{size}b"
+
+
+class ExportCancelled(Exception):
+    """The export has been cancelled, since a volume couldn't be uploaded."""
+
+
+class VolumeWriter:
+    """File-like object, which splits everything written to it into volumes.
+
+    Volumes are named like 7z volumes `{base_path}.001`, `{base_path}.002`, ...
+    Each finished volume is handed to the `on_volume` callback.
+    """
+
+    def __init__(self, base_path, volume_size, on_volume):
+        """Create a new writer."""
+        self.base_path = base_path
+        self.volume_size = volume_size
+        self.on_volume = on_volume
+
+        self.count = 0
+        self.file_descriptor = None
+        self.path = None
+        self.written = 0
+        # Nothing is written anymore, once the export failed.
+        self.aborted = False
+
+    def write(self, data):
+        """Write data and start a new volume, whenever the current one is full."""
+        if self.aborted:
+            return
+
+        data = memoryview(data)
+        while len(data) > 0:
+            if self.file_descriptor is None:
+                self.count += 1
+                self.path = f"{self.base_path}.{self.count:03d}"
+                self.file_descriptor = open(self.path, "wb")
+                self.written = 0
+
+            chunk = data[: self.volume_size - self.written]
+            self.file_descriptor.write(chunk)
+            self.written += len(chunk)
+            data = data[len(chunk) :]
+
+            if self.written == self.volume_size:
+                self.finish_volume()
+
+    def finish_volume(self):
+        """Close the current volume and hand it over."""
+        self.file_descriptor.close()
+        self.file_descriptor = None
+        try:
+            self.on_volume(self.path)
+        except BaseException:
+            self.aborted = True
+            raise
+
+    def close(self):
+        """Finish the last volume."""
+        if self.file_descriptor is not None:
+            self.finish_volume()
+
+    def abort(self):
+        """Stop writing and remove the unfinished volume."""
+        self.aborted = True
+        if self.file_descriptor is not None:
+            self.file_descriptor.close()
+            self.file_descriptor = None
+            os.remove(self.path)
+
+
+async def export_files(base_path, files, volume_size, upload, add_file):
+    """Write files into a tar archive split into volumes and upload each finished volume.
+
+    Each file is added with `add_file(archive, path, name)`, which reads it from its storage.
+
+    The archive is written in the file system threads, so the event loop isn't blocked.
+    Each volume is uploaded and deleted, while the next one is written.
+    The writer waits before handing over another volume, until the previous one is uploaded.
+    Thereby there are at most two volumes on disk, while the export runs.
+    If it fails, the volume, which couldn't be handed over anymore, is left behind.
+    The caller has to remove the directory of the volumes.
+
+    Returns the amount of uploaded volumes.
+    """
+    loop = asyncio.get_running_loop()
+    volumes = asyncio.Queue()
+    # Only one finished volume may wait for its upload at any time.
+    upload_slot = threading.Semaphore(1)
+    cancelled = threading.Event()
+
+    def on_volume(path):
+        upload_slot.acquire()
+        if cancelled.is_set():
+            raise ExportCancelled()
+        loop.call_soon_threadsafe(volumes.put_nowait, path)
+
+    def write_archive():
+        writer = VolumeWriter(base_path, volume_size, on_volume)
+        try:
+            with tarfile.open(fileobj=writer, mode="w|") as archive:
+                for path, name in files:
+                    add_file(archive, path, name)
+            writer.close()
+        except BaseException:
+            # The tar stream is flushed on errors as well. Don't keep that volume open.
+            writer.abort()
+            raise
+        finally:
+            # Signal the end of the archive.
+            loop.call_soon_threadsafe(volumes.put_nowait, None)
+
+    builder = loop.run_in_executor(filesystem.executor, write_archive)
+
+    count = 0
+    try:
+        while True:
+            path = await volumes.get()
+            if path is None:
+                break
+
+            await upload(path)
+            await filesystem.remove(path)
+            upload_slot.release()
+            count += 1
+    except BaseException:
+        # Let the writer run into the cancellation, instead of waiting forever.
+        cancelled.set()
+        upload_slot.release()
+        raise
+    finally:
+        try:
+            await builder
+        except ExportCancelled:
+            pass
+
+    return count
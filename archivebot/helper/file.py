@@ -1,48 +1,77 @@
 """Helper module for file helper."""
 import os
-import subprocess
 from datetime import datetime
 
-from telethon import types
+from sqlalchemy.exc import IntegrityError
+from telethon import types, utils
 
 from archivebot.config import config
 from archivebot.helper import get_peer_information, get_username
+from archivebot.helper.admission import get_media_info, release_quota, reserve_quota
+from archivebot.helper.cache import entity_cache, parse_accepted_media
+from archivebot.helper.filesystem import filesystem
 from archivebot.models.file import File
 from archivebot.sentry import sentry
+from archivebot.storage import storage
 
+# Directories in the target directory, which aren't chats.
+reserved_names = ["zips", ".blobs", ".trash"]
 
-async def create_file(session, event, subscriber, message, user, full_scan):
-    """Create a file object from a message."""
+
+async def create_file(
+    session, event, subscriber, message, user, full_scan, notices, check_exists=True
+):
+    """Create a file object from a message.
+
+    Batches of messages, whose known files have already been filtered, skip the existence check.
+    Messages for the user are added to `notices`. They're sent after the commit,
+    so the transaction is never kept open while waiting for telegram.
+    """
     to_id, to_type = get_peer_information(message.to_id)
 
-    file_type, file_id = await get_file_information(
-        event, message, subscriber, user, full_scan
+    file_type, file_id = get_file_information(
+        message, subscriber, user, full_scan, notices
     )
     if not file_type:
         return None
 
     # Check if this exact file from the same message is already downloaded.
     # This is a hard constraint which shouldn't be violated.
-    if File.exists(session, subscriber, file_id):
+    if check_exists and await File.exists(session, subscriber, file_id):
         return None
 
-    # The file path is depending on the media type.
-    # In case such a file already exists and duplicate files are disabled, the function returns None.
-    # In that case we will return early.
-    file_path, file_name = get_file_path(subscriber, get_username(user), message)
-
     # Don't check zipped files from ourselves.
     # Otherwise we would double in size on each /scan_chat /zip command combination
-    me = await event.client.get_me()
+    file_name = get_file_name(message)
+    me = await entity_cache.get_me(event.client)
     splitted = file_name.rsplit(".", maxsplit=2)
-    if user.id == me.id and len(splitted) == 3 and splitted[1] == "7z":
+    if user.id == me.id and len(splitted) == 3 and splitted[1] in ["7z", "tar"]:
         return None
 
+    # The size is counted towards the quota of the chat, before any byte is downloaded.
+    size, _ = get_media_info(message)
+    if not await reserve_quota(session, subscriber, size or 0):
+        if subscriber.verbose:
+            notices.append(
+                f"The storage quota of this chat is used up. Skipping {file_name}."
+            )
+        return None
+
+    # The file path is depending on the media type.
+    # In case such a file already exists and duplicate files are disabled, the function returns None.
+    # In that case we will return early.
+    file_path, file_name = await get_file_path(
+        subscriber, get_username(user), file_name
+    )
+
     if file_path is None:
+        await release_quota(
+            session, subscriber.chat_id, subscriber.chat_type, size or 0
+        )
+
         # Inform the user about duplicate files
         if subscriber.verbose:
-            text = f"File with name {file_name} already exists."
-            await event.respond(text)
+            notices.append(f"File with name {file_name} already exists.")
 
         sentry.captureMessage(
             "File already exists",
@@ -67,28 +96,28 @@ async def create_file(session, event, subscriber, message, user, full_scan):
         file_type,
         file_name,
         file_path,
+        size,
     )
 
-    session.add(new_file)
-    session.commit()
+    # The file is committed together with the rest of the event or scan batch.
+    # Only the file is rolled back, if another bot process archived the same media meanwhile.
+    try:
+        async with session.begin_nested():
+            session.add(new_file)
+    except IntegrityError:
+        await release_quota(
+            session, subscriber.chat_id, subscriber.chat_type, size or 0
+        )
+        await storage.release(file_path)
+        return None
 
     return new_file
 
 
-def get_chat_path(chat_name):
-    """Compile the directory path for this chat."""
-    return os.path.join(config["download"]["target_dir"], chat_name)
-
-
-def init_zip_dir(chat_name):
+async def init_zip_dir(chat_name):
     """Create the zip directory for this chat."""
-    zip_dir = os.path.join(config["download"]["target_dir"], "zips")
-    if not os.path.exists(zip_dir):
-        os.mkdir(zip_dir)
-
-    zip_dir = os.path.join(zip_dir, chat_name)
-    if not os.path.exists(zip_dir):
-        os.mkdir(zip_dir)
+    zip_dir = get_zip_file_path(chat_name)
+    await filesystem.makedirs(zip_dir)
 
     return zip_dir
 
@@ -98,59 +127,57 @@ def get_zip_file_path(chat_name):
     return os.path.join(config["download"]["target_dir"], "zips", chat_name)
 
 
-def get_file_path(subscriber, username, message):
-    """Compile the file path and ensure the parent directories exist."""
-    # If we don't sort by user, use the chat_path
-    if not subscriber.sort_by_user:
-        directory = get_chat_path(subscriber.chat_name)
-    # sort_by_user is active. Add the user directory.
-    else:
-        directory = os.path.join(
-            get_chat_path(subscriber.chat_name),
-            username.lower(),
-        )
-
-    # Create the directory
-    if not os.path.exists(directory):
-        os.makedirs(directory, exist_ok=True)
-
+def get_file_name(message):
+    """Get the name of the file of a message, including its extension."""
     # We have a document. Documents have a filename attribute.
-    # Use this for choosing the exact file path.
+    # Use this for choosing the exact file name.
     if message.document:
         for attribute in message.document.attributes:
-            # Document has a file name attribute
             if isinstance(attribute, types.DocumentAttributeFilename):
-                file_name = attribute.file_name
-                # Path exists. Return None if duplicate files are disallowed.
-                if os.path.exists(os.path.join(directory, file_name)):
-                    if not subscriber.allow_duplicates:
-                        return None, file_name
-                    else:
-                        file_name = find_file_name(directory, file_name)
+                return add_extension(message, attribute.file_name)
+
+    # Photos have no file name. Use the current time instead.
+    return add_extension(message, datetime.now().strftime("media_%Y-%m-%d_%H-%M-%S"))
+
+
+async def get_file_path(subscriber, username, file_name):
+    """Compile the file path and reserve it in the storage backend.
+
+    Returns None as path, if the name is taken and duplicate files are disallowed.
+    """
+    # If we don't sort by user, the file is stored directly in the chat.
+    directory = None
+    # sort_by_user is active. Add the user directory.
+    if subscriber.sort_by_user:
+        directory = username.lower()
+
+    return await storage.reserve(
+        subscriber.chat_name, directory, file_name, subscriber.allow_duplicates
+    )
+
+
+def add_extension(message, file_path):
+    """Add the extension of the media to a file path, if it doesn't have one yet.
 
-                file_path = os.path.join(directory, file_name)
-                return (file_path, file_name)
+    Telethon only does this by itself, if it downloads into a path.
+    """
+    if not os.path.splitext(file_path)[1]:
+        file_path += utils.get_extension(message.media)
 
-    file_name = datetime.now().strftime("media_%Y-%m-%d_%H-%M-%S")
-    file_path = os.path.join(directory, file_name)
-    # We have a photo. Photos have no file name, thereby return the directory
-    # and let telethon decide the name of the file.
-    return (file_path, file_name)
+    return file_path
 
 
-def find_file_name(directory, file_name):
-    """Find a file name which doesn't exist yet."""
-    counter = 1
-    original_file_name, extension = os.path.splitext(file_name)
-    file_name = f"{original_file_name}_{counter}{extension}"
-    while os.path.exists(os.path.join(directory, file_name)):
-        counter += 1
-        file_name = f"{original_file_name}_{counter}{extension}"
+def get_media_id(message):
+    """Get the telegram id of the media of a message, without any further checks."""
+    if message.document is not None:
+        return message.document.id
+    elif message.photo is not None:
+        return message.photo.id
 
-    return file_name
+    return None
 
 
-async def get_file_information(event, message, subscriber, user, full_scan):
+def get_file_information(message, subscriber, user, full_scan, notices):
     """Extract and return all information about the given file.
 
     At the same time we check, whether we actually want this file.
@@ -159,7 +186,7 @@ async def get_file_information(event, message, subscriber, user, full_scan):
     file_id = None
     file_type = None
 
-    accepted_media = subscriber.accepted_media.split(" ")
+    accepted_media = parse_accepted_media(subscriber.accepted_media)
 
     # Check for stickers
     if "sticker" in accepted_media and message.sticker is not None:
@@ -182,16 +209,6 @@ async def get_file_information(event, message, subscriber, user, full_scan):
     elif message.photo is not None:
         # Flame the user that compressed photos are evil
         if subscriber.verbose and full_scan:
-            text = f"Please send uncompressed files @{user.username} :(."
-            await event.respond(text)
+            notices.append(f"Please send uncompressed files @{user.username} :(.")
 
     return file_type, file_id
-
-
-def create_zips(chat_name, zip_dir, target_dir):
-    """Create a zip file from a given dir path."""
-    file_name = os.path.join(zip_dir, chat_name)
-    volume_size = config["zip"]["volume_size"]
-    command = ["7z", f"-v{volume_size}", "a", f"{file_name}.7z", target_dir]
-
-    subprocess.run(command)
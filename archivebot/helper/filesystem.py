@@ -0,0 +1,65 @@
+"""Run blocking file system operations without blocking the event loop.
+
+On network storage even a single `stat` may take tens of milliseconds and
+moving or deleting a big directory can take minutes. All of these calls
+are run in a dedicated thread pool, so they don't compete with other
+executor work and every other chat is still served in the meantime.
+"""
+import asyncio
+import functools
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from archivebot.config import config
+
+
+class FileSystem(object):
+    """Async wrappers for the file system calls of the bot."""
+
+    def __init__(self, workers):
+        """Create the thread pool with the given amount of workers."""
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="archivebot-fs"
+        )
+
+    async def run(self, function, *args, **kwargs):
+        """Run any blocking function in the file system thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs)
+        )
+
+    async def exists(self, path):
+        """Check whether a path exists."""
+        return await self.run(os.path.exists, path)
+
+    async def getsize(self, path):
+        """Get the size of a file."""
+        return await self.run(os.path.getsize, path)
+
+    async def realpath(self, path):
+        """Resolve all symlinks of a path."""
+        return await self.run(os.path.realpath, path)
+
+    async def listdir(self, path):
+        """List the names of a directory."""
+        return await self.run(os.listdir, path)
+
+    async def makedirs(self, path):
+        """Create a directory and all of its parents, if they don't exist yet."""
+        await self.run(os.makedirs, path, exist_ok=True)
+
+    async def rename(self, source, destination):
+        """Rename a file or directory."""
+        await self.run(os.rename, source, destination)
+
+    async def remove(self, path):
+        """Remove a single file."""
+        await self.run(os.remove, path)
+
+    async def rmtree(self, path):
+        """Remove a directory with all of its content."""
+        await self.run(shutil.rmtree, path, ignore_errors=True)
+
+
+filesystem = FileSystem(config["download"]["filesystem_workers"])
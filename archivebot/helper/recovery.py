@@ -0,0 +1,173 @@
+"""Recover downloads, which have been interrupted by a crash or a shutdown.
+
+Files are registered in the database before they are downloaded.
+If the bot dies in between, the file stays unsuccessful and would never be downloaded,
+since it's already known. These files are either completed or downloaded again.
+"""
+import traceback
+
+from sqlalchemy import select, tuple_
+
+from archivebot.db import get_session
+from archivebot.helper import get_peer
+from archivebot.helper.admission import release_quota
+from archivebot.helper.download import DownloadJob, download_queue
+from archivebot.helper.file import add_extension
+from archivebot.helper.scheduler import SCAN
+from archivebot.helper.shard import get_own_chat_condition
+from archivebot.models import File
+from archivebot.sentry import sentry
+from archivebot.storage import storage
+
+# The amount of files, that are checked at once.
+RECOVERY_BATCH_SIZE = 100
+# Recovered files are only queued, while fewer scan downloads than this are waiting.
+RECOVERY_QUEUE_LIMIT = 500
+
+
+async def get_complete_path(message, known_file):
+    """Get the path of a file, if it has been downloaded completely.
+
+    Only documents can be checked, since the size of a downloaded photo isn't known.
+    """
+    if message.document is None:
+        return None
+
+    paths = [known_file.file_path, add_extension(message, known_file.file_path)]
+    for path in paths:
+        if (
+            await storage.exists(path)
+            and await storage.get_size(path) == message.document.size
+        ):
+            return path
+
+    return None
+
+
+async def get_messages(client, files):
+    """Get the messages of the given files. Deleted messages are None."""
+    messages = {}
+    files_by_chat = {}
+    for known_file in files:
+        chat = (known_file.to_id, known_file.to_type)
+        files_by_chat.setdefault(chat, []).append(known_file)
+
+    for (to_id, to_type), chat_files in files_by_chat.items():
+        try:
+            chat_messages = await client.get_messages(
+                get_peer(to_id, to_type),
+                ids=[known_file.message_id for known_file in chat_files],
+            )
+        except Exception:
+            # We might have lost access to this chat. Try again on the next start.
+            traceback.print_exc()
+            sentry.captureException()
+            continue
+
+        for known_file, message in zip(chat_files, chat_messages):
+            messages[known_file] = message
+
+    return messages
+
+
+async def recover_batch(client, files):
+    """Complete or queue a batch of unsuccessful files."""
+    # The messages are fetched first, so no connection is held during the requests.
+    messages = await get_messages(client, files)
+
+    session = get_session()
+    try:
+        jobs = await check_files(session, messages)
+        await session.commit()
+    finally:
+        await session.close()
+
+    for job in jobs:
+        download_queue.put(job)
+
+
+async def check_files(session, messages):
+    """Update the files, which don't need to be downloaded, and return jobs for the others."""
+    jobs = []
+    for known_file, message in messages.items():
+        file_key = (known_file.message_id, known_file.to_id, known_file.from_id)
+        # This download has been started since the last start.
+        if download_queue.is_queued(file_key):
+            continue
+
+        # The message has been deleted in the meantime.
+        # Forget the file, so it can be archived again, if it's posted again.
+        # Its placeholder or partial download would be left behind as an orphan otherwise.
+        if message is None or message.media is None:
+            session.add(known_file)
+            await session.delete(known_file)
+            await release_quota(
+                session,
+                known_file.subscriber_chat_id,
+                known_file.subscriber_chat_type,
+                known_file.size or 0,
+            )
+            await storage.release(known_file.file_path)
+            continue
+
+        # The download finished, but the bot died before it could be marked.
+        path = await get_complete_path(message, known_file)
+        if path is not None:
+            downloaded_at = await storage.get_modified(path)
+            session.add(known_file)
+            known_file.success = True
+            known_file.file_path = path
+            known_file.downloaded_at = downloaded_at
+            continue
+
+        jobs.append(DownloadJob(message, known_file, SCAN))
+
+    return jobs
+
+
+async def recover_downloads(client):
+    """Check all unsuccessful files batch by batch and download them again.
+
+    Files, that failed too often, aren't touched.
+    Chunked downloads continue at their stored offset.
+    This runs in the background, while the bot is already working.
+    """
+    try:
+        await recover_files(client)
+    except Exception:
+        traceback.print_exc()
+        sentry.captureException()
+
+
+async def recover_files(client):
+    """Recover all unsuccessful files in the order of their keys."""
+    last_key = None
+    while True:
+        # Don't load all messages at once, if there are lots of files to recover.
+        await download_queue.wait_for_capacity(RECOVERY_QUEUE_LIMIT, SCAN)
+
+        async with get_session() as session:
+            query = (
+                select(File)
+                .join(File.subscriber)
+                .where(File.success.is_(False))
+                .where(File.attempts < download_queue.max_attempts)
+                # Files of other shards are recovered by their own bot process.
+                .where(get_own_chat_condition())
+                .order_by(File.message_id, File.to_id, File.from_id)
+                .limit(RECOVERY_BATCH_SIZE)
+            )
+            if last_key is not None:
+                query = query.where(
+                    tuple_(File.message_id, File.to_id, File.from_id) > last_key
+                )
+
+            result = await session.execute(query)
+            files = result.scalars().all()
+
+        if len(files) == 0:
+            return
+
+        last = files[-1]
+        last_key = tuple_(last.message_id, last.to_id, last.from_id)
+        await recover_batch(client, files)
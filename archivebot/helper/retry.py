@@ -0,0 +1,84 @@
+"""Helper for retrying telegram requests without blocking the event loop."""
+import asyncio
+import random
+import time
+
+from telethon.errors import FloodWaitError
+
+from archivebot.metrics import metrics
+
+# The base and the maximum delay in seconds for the exponential backoff.
+BACKOFF_BASE = 2
+BACKOFF_MAX = 300
+
+
+def get_backoff(attempt):
+    """Get the delay before the next try with exponential backoff and jitter."""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+    return random.uniform(delay / 2, delay)
+
+
+class FloodGate:
+    """Keep track of the flood waits telegram imposed on us.
+
+    Flood waits can be global (dc_id None) or only affect a single data center.
+    Requests to other data centers can continue, while one is blocked.
+    """
+
+    def __init__(self):
+        """Create a new open gate."""
+        self.blocked_until = {}
+
+    def block(self, seconds, dc_id=None):
+        """Block requests to a data center for the given amount of seconds."""
+        metrics.flood_waits.inc()
+        metrics.flood_wait_seconds.inc(seconds)
+        until = time.monotonic() + seconds
+        self.blocked_until[dc_id] = max(until, self.blocked_until.get(dc_id, 0))
+
+    def get_delay(self, dc_id=None):
+        """Get the seconds until requests to a data center are allowed again."""
+        until = max(
+            self.blocked_until.get(None, 0),
+            self.blocked_until.get(dc_id, 0),
+        )
+        return max(0, until - time.monotonic())
+
+    def get_pause(self, cooldown):
+        """Get the seconds, for which background work should pause.
+
+        Background work pauses, while any data center is blocked and `cooldown` seconds afterwards.
+        """
+        if not self.blocked_until:
+            return 0
+
+        return max(0, max(self.blocked_until.values()) + cooldown - time.monotonic())
+
+    async def wait(self, dc_id=None):
+        """Wait until requests to a data center are allowed again."""
+        delay = self.get_delay(dc_id)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.get_delay(dc_id)
+
+
+flood_gate = FloodGate()
+
+
+async def call_with_retries(func, *args, tries=3, dc_id=None, **kwargs):
+    """Call a coroutine function and retry it on flood waits and timeouts.
+
+    All waiting is done with asyncio, so other work continues in the meantime.
+    """
+    for attempt in range(tries):
+        await flood_gate.wait(dc_id)
+        try:
+            return await func(*args, **kwargs)
+        except FloodWaitError as e:
+            flood_gate.block(e.seconds + 1, dc_id)
+            if attempt + 1 == tries:
+                raise
+        except (TimeoutError, asyncio.TimeoutError):
+            if attempt + 1 == tries:
+                raise
+            await asyncio.sleep(get_backoff(attempt))
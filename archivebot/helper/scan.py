@@ -0,0 +1,86 @@
+"""Helper for scanning the history of a chat."""
+import time
+
+from telethon import types
+from telethon.errors import MessageNotModifiedError
+
+from archivebot.helper.cache import parse_accepted_media
+
+# Amount of messages, whose files are checked against the database at once.
+SCAN_BATCH_SIZE = 100
+# The next batch is only scanned, while fewer scan downloads than this are waiting.
+# Scan downloads are rate-limited, so this keeps the scan from running far ahead.
+SCAN_QUEUE_LIMIT = 500
+
+# Minimum amount of seconds between two edits of the progress message.
+PROGRESS_INTERVAL = 10
+
+# Telegram only allows a single filter per history request.
+# Thereby we do one pass over the history for each filter, that's needed for the accepted media.
+# There's no filter for stickers, so the history has to be scanned unfiltered in that case.
+scan_filters = {
+    "photo": [types.InputMessagesFilterPhotos],
+    "document": [
+        types.InputMessagesFilterDocument,
+        types.InputMessagesFilterVideo,
+        types.InputMessagesFilterGif,
+        types.InputMessagesFilterMusic,
+        types.InputMessagesFilterRoundVoice,
+    ],
+}
+
+
+def get_scan_filters(subscriber):
+    """Get the names and filters of all passes, that are needed to scan this chat."""
+    accepted_media = parse_accepted_media(subscriber.accepted_media)
+    if "sticker" in accepted_media:
+        return [("all", None)]
+
+    filters = []
+    for media in ["photo", "document"]:
+        if media in accepted_media:
+            for message_filter in scan_filters[media]:
+                filters.append((message_filter.__name__, message_filter))
+
+    return filters
+
+
+def get_remaining_scan_filters(subscriber):
+    """Get the passes that still need to be done.
+
+    If a previous scan has been interrupted, we continue with the pass it stopped in.
+    """
+    filters = get_scan_filters(subscriber)
+    names = [name for name, _ in filters]
+    if subscriber.scan_filter in names:
+        return filters[names.index(subscriber.scan_filter) :]
+
+    subscriber.scan_offset_id = None
+    return filters
+
+
+class ScanProgress:
+    """Report the progress of a scan by periodically editing a single message."""
+
+    def __init__(self, message):
+        """Create a new progress reporter."""
+        self.message = message
+        self.scanned = 0
+        self.queued = 0
+        self.last_update = time.monotonic()
+
+    def get_text(self):
+        """Format the progress text."""
+        return f"Scanned {self.scanned} messages, found {self.queued} new files."
+
+    async def update(self, text=None, force=False):
+        """Edit the progress message, if the last edit is long enough ago."""
+        now = time.monotonic()
+        if not force and now - self.last_update < PROGRESS_INTERVAL:
+            return
+
+        self.last_update = now
+        try:
+            await self.message.edit(text or self.get_text())
+        except MessageNotModifiedError:
+            pass
@@ -0,0 +1,91 @@
+"""Building blocks for scheduling downloads by priority."""
+import time
+from collections import OrderedDict, deque
+
+# Files of new messages are downloaded before any background work.
+LIVE = 0
+# Files found by /scan_chat or by the recovery of interrupted downloads.
+SCAN = 1
+
+
+class ChatQueue:
+    """Jobs grouped by chat. The chats are served round-robin."""
+
+    def __init__(self):
+        """Create a new empty queue."""
+        # Pending jobs by chat. The order of the keys is the round-robin order.
+        self.jobs = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        """Return the amount of pending jobs."""
+        return self.size
+
+    def __contains__(self, chat_key):
+        """Check whether there are pending jobs for a chat."""
+        return chat_key in self.jobs
+
+    def put(self, job):
+        """Add a job to the end of the queue of its chat."""
+        if job.chat_key not in self.jobs:
+            self.jobs[job.chat_key] = deque()
+        self.jobs[job.chat_key].append(job)
+        self.size += 1
+
+    def pop(self, is_ready):
+        """Get the next job of the next chat, for which `is_ready(chat_key)` is true."""
+        for chat_key in list(self.jobs.keys()):
+            if not is_ready(chat_key):
+                continue
+
+            # Take the chat out of the rotation and put it back to the end,
+            # if there are still jobs left.
+            jobs = self.jobs.pop(chat_key)
+            job = jobs.popleft()
+            if jobs:
+                self.jobs[chat_key] = jobs
+
+            self.size -= 1
+            return job
+
+        return None
+
+    def discard(self, chat_key):
+        """Remove and return all jobs of a chat."""
+        jobs = self.jobs.pop(chat_key, [])
+        self.size -= len(jobs)
+        return jobs
+
+
+class RateLimiter:
+    """A token bucket, which allows `rate` operations per second on average.
+
+    Up to `burst` operations may happen at once after a quiet period.
+    """
+
+    def __init__(self, rate, burst):
+        """Create a new full bucket."""
+        self.rate = rate
+        # At least a single operation has to fit into the bucket.
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        """Add the tokens, that accumulated since the last update."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_delay(self):
+        """Get the seconds until the next operation is allowed."""
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Use up a token for an operation."""
+        self.refill()
+        self.tokens -= 1
@@ -1,7 +1,11 @@
 """Session handling for commands."""
+import time
 import traceback
 
 from archivebot.db import get_session
+from archivebot.helper.cache import entity_cache
+from archivebot.helper.retry import call_with_retries
+from archivebot.metrics import metrics
 from archivebot.sentry import sentry
 
 
@@ -14,7 +18,7 @@ def session_wrapper(addressed=True):
         async def wrapper(event):
             if addressed:
                 # Check if this message is meant for us
-                bot_user = await event.client.get_me()
+                bot_user = await entity_cache.get_me(event.client)
                 username = bot_user.username.lower()
                 recipient_string = f"@{username}"
 
@@ -22,21 +26,30 @@ def session_wrapper(addressed=True):
                 # Only accept commands send with an recipient string
                 command = event.message.message.split(" ", maxsplit=1)[0]
                 if recipient_string not in command.lower():
+                    metrics.events.labels(func.__name__, "dropped").inc()
                     return
 
+            metrics.events.labels(func.__name__, "handled").inc()
+            start = time.perf_counter()
             session = get_session()
             try:
                 response = await func(event, session)
-                session.commit()
+                # Everything an event changed is committed at once.
+                with metrics.db_seconds.labels("commit").time():
+                    await session.commit()
+                # The response is sent after the commit, so no transaction waits for telegram.
                 if response:
-                    await event.respond(response)
+                    await call_with_retries(event.respond, response)
             except BaseException:
                 if addressed:
                     await event.respond("Some unknown error occurred.")
                 traceback.print_exc()
                 sentry.captureException()
             finally:
-                session.remove()
+                await session.close()
+                metrics.handler_seconds.labels(func.__name__).observe(
+                    time.perf_counter() - start
+                )
 
         return wrapper
 
@@ -0,0 +1,122 @@
+"""Run several bot processes with different accounts on a shared database and storage.
+
+Each process is a shard with a name of its own. A chat belongs to the shard,
+on which `/start` has been issued last. Chats without a shard, e.g. from before
+shards existed, are archived by the shard named `default`.
+The settings of all chats are reloaded periodically, so a `/start` on another shard
+is picked up, see `SubscriberCache.refresh`.
+
+Downloads are claimed in the database, before they are started.
+That way a file is only ever downloaded by a single process, even if several
+processes picked it up. Claims of crashed processes expire after `claim_timeout`.
+"""
+import asyncio
+import os
+import socket
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, update
+
+from archivebot.config import config
+from archivebot.db import get_session
+from archivebot.models.file import File
+from archivebot.models.subscriber import Subscriber
+
+# The shard, which archives all chats without a shard.
+DEFAULT_SHARD = "default"
+
+shard_name = config["shard"]["name"]
+# Identifies this process in the claims of the database.
+worker_id = f"{shard_name}:{socket.gethostname()}:{os.getpid()}"
+
+
+def is_own_chat(subscriber):
+    """Check whether a chat is archived by this shard."""
+    return (subscriber.shard or DEFAULT_SHARD) == shard_name
+
+
+def get_own_chat_condition():
+    """Get the condition, which selects the subscribers of this shard."""
+    if shard_name == DEFAULT_SHARD:
+        return or_(Subscriber.shard.is_(None), Subscriber.shard == shard_name)
+
+    return Subscriber.shard == shard_name
+
+
+def get_file_condition(file_key):
+    """Get the condition, which selects a single file by its key."""
+    message_id, to_id, from_id = file_key
+    return (
+        (File.message_id == message_id)
+        & (File.to_id == to_id)
+        & (File.from_id == from_id)
+    )
+
+
+class FileClaim:
+    """The exclusive right of this process to download a file.
+
+    The claim is renewed in the background, as long as it's held,
+    so long downloads don't lose their claim to another process.
+    """
+
+    def __init__(self, file_key):
+        """Create a new claim for a file, which isn't acquired yet."""
+        self.file_key = file_key
+        self.timeout = config["shard"]["claim_timeout"]
+        self.renewal = None
+
+    async def acquire(self):
+        """Claim the file. Returns False, if it's claimed by another process or done."""
+        now = datetime.now()
+        async with get_session() as session:
+            result = await session.execute(
+                update(File)
+                .where(get_file_condition(self.file_key))
+                .where(File.success.is_(False))
+                .where(
+                    or_(
+                        File.claimed_by.is_(None),
+                        File.claimed_by == worker_id,
+                        File.claimed_at < now - timedelta(seconds=self.timeout),
+                    )
+                )
+                .values(claimed_by=worker_id, claimed_at=now)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+
+        if result.rowcount != 1:
+            return False
+
+        self.renewal = asyncio.get_running_loop().create_task(self.renew())
+        return True
+
+    async def renew(self):
+        """Refresh the claim, before it expires."""
+        while True:
+            await asyncio.sleep(self.timeout / 3)
+            async with get_session() as session:
+                await session.execute(
+                    update(File)
+                    .where(get_file_condition(self.file_key))
+                    .where(File.claimed_by == worker_id)
+                    .values(claimed_at=datetime.now())
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+
+    async def release(self):
+        """Give up the claim, so the file can be picked up again."""
+        if self.renewal is not None:
+            self.renewal.cancel()
+
+        async with get_session() as session:
+            await session.execute(
+                update(File)
+                .where(get_file_condition(self.file_key))
+                .where(File.claimed_by == worker_id)
+                .values(claimed_by=None, claimed_at=None)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
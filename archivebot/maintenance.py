@@ -0,0 +1,332 @@
+"""Offline maintenance of the archive. Nothing in here connects to telegram.
+
+The target directory is walked with parallel scandir calls and compared
+with the file table in bulk. Downloaded files, which vanished from disk, are
+marked as unsuccessful, so they're recovered on the next start of the bot.
+Files on disk without a database entry are registered as orphans.
+Blobs, which aren't referenced by any file anymore, are removed.
+"""
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from sqlalchemy import bindparam, delete, insert, select, update
+from sqlalchemy.orm import Session
+
+from archivebot.config import config
+from archivebot.db import engine
+from archivebot.helper.blob import (
+    delete_unreferenced_blobs,
+    hash_file,
+    remove_blob_files,
+)
+from archivebot.helper.file import reserved_names
+from archivebot.models import Blob, File, OrphanFile, Subscriber
+
+# The amount of rows, which are updated or inserted with a single statement.
+BATCH_SIZE = 1000
+
+
+def scan_directory(path):
+    """List the files with their sizes and the subdirectories of a single directory."""
+    files = []
+    directories = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                # Chunked downloads, which are still in progress.
+                if entry.name.endswith(".part"):
+                    continue
+                files.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+
+    return files, directories
+
+
+def scan_storage(target_dir, workers):
+    """Get the size of every file in the chat directories by its path.
+
+    Directories are scanned in parallel, which pays off on network file systems.
+    """
+    storage = {}
+    with ThreadPoolExecutor(workers) as executor:
+        pending = set()
+        for name in os.listdir(target_dir):
+            path = os.path.join(target_dir, name)
+            if name not in reserved_names and os.path.isdir(path):
+                pending.add(executor.submit(scan_directory, path))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, directories = future.result()
+                storage.update(files)
+                for directory in directories:
+                    pending.add(executor.submit(scan_directory, directory))
+
+    return storage
+
+
+def hash_files(paths, workers):
+    """Get the sha256 hash of every given file by its path."""
+    paths = list(paths)
+    with ThreadPoolExecutor(workers) as executor:
+        results = executor.map(hash_file, paths)
+        return {path: sha256 for path, (sha256, _) in zip(paths, results)}
+
+
+class Report:
+    """The differences between the database and the files on disk."""
+
+    def __init__(self):
+        """Create an empty report."""
+        # Keys of successful files, which don't exist on disk.
+        self.missing = []
+        # Keys of successful files, whose size differs from the size of the media.
+        self.incomplete = []
+        # Keys of deduplicated files, whose content doesn't match their blob.
+        self.corrupt = []
+        # Paths and sizes of files on disk without database entry.
+        self.orphans = []
+        self.hashes = {}
+        # Unreferenced blobs, which have been removed, and their size.
+        self.removed_blobs = 0
+        self.freed_bytes = 0
+
+        self.files = 0
+        self.bytes = 0
+        self.hashed_bytes = 0
+        self.scan_seconds = 0
+        self.hash_seconds = 0
+
+    def get_broken(self):
+        """Get the keys of all files, that need to be downloaded again."""
+        return self.missing + self.incomplete + self.corrupt
+
+    def get_text(self):
+        """Format the report and the throughput of the scan."""
+        text = (
+            f"Scanned {self.files} files ({self.bytes / 1024**3:.2f} GiB) "
+            f"in {self.scan_seconds:.1f}s, "
+            f"{self.files / max(self.scan_seconds, 0.001):.0f} files/s.\n"
+        )
+        if self.hash_seconds:
+            text += (
+                f"Hashed {self.hashed_bytes / 1024**3:.2f} GiB "
+                f"in {self.hash_seconds:.1f}s, "
+                f"{self.hashed_bytes / 1024**2 / max(self.hash_seconds, 0.001):.0f} MiB/s.\n"
+            )
+
+        text += (
+            f"Missing files: {len(self.missing)}\n"
+            f"Incomplete files: {len(self.incomplete)}\n"
+            f"Corrupt files: {len(self.corrupt)}\n"
+            f"Orphaned files: {len(self.orphans)}"
+        )
+        return text
+
+
+def check_storage(session, rehash, workers):
+    """Compare the file table with the target directory.
+
+    With `rehash`, deduplicated files are checked against the hash of their blob
+    and the hashes of orphans are computed.
+    """
+    target_dir = config["download"]["target_dir"]
+    report = Report()
+
+    start = time.perf_counter()
+    storage = scan_storage(target_dir, workers)
+    report.scan_seconds = time.perf_counter() - start
+    report.files = len(storage)
+    report.bytes = sum(storage.values())
+
+    known_paths = set()
+    to_hash = {}
+    blobs = dict(session.execute(select(Blob.media_id, Blob.sha256)).all())
+    result = session.execute(
+        select(
+            File.message_id,
+            File.to_id,
+            File.from_id,
+            File.file_id,
+            File.file_path,
+            File.success,
+            File.size,
+        ).execution_options(yield_per=BATCH_SIZE)
+    )
+    for message_id, to_id, from_id, file_id, path, success, size in result:
+        known_paths.add(path)
+        # Unsuccessful files are still waiting for their download.
+        if not success:
+            continue
+
+        key = (message_id, to_id, from_id)
+        if path not in storage:
+            report.missing.append(key)
+        elif size is not None and storage[path] != size:
+            report.incomplete.append(key)
+        elif rehash and file_id in blobs:
+            to_hash[path] = (key, blobs[file_id])
+
+    report.orphans = [
+        (path, size) for path, size in storage.items() if path not in known_paths
+    ]
+
+    if rehash:
+        paths = list(to_hash) + [path for path, _ in report.orphans]
+        start = time.perf_counter()
+        report.hashes = hash_files(paths, workers)
+        report.hash_seconds = time.perf_counter() - start
+        report.hashed_bytes = sum(storage[path] for path in paths)
+
+        for path, (key, sha256) in to_hash.items():
+            if report.hashes[path] != sha256:
+                report.corrupt.append(key)
+
+    return report
+
+
+def apply_report(session, report):
+    """Mark broken files for a new download and replace the registered orphans."""
+    broken = report.get_broken()
+    statement = (
+        update(File)
+        .where(File.message_id == bindparam("key_message_id"))
+        .where(File.to_id == bindparam("key_to_id"))
+        .where(File.from_id == bindparam("key_from_id"))
+        .values(success=False, attempts=0, downloaded_at=None, download_offset=0)
+        .execution_options(synchronize_session=False)
+    )
+    for index in range(0, len(broken), BATCH_SIZE):
+        session.connection().execute(
+            statement,
+            [
+                {
+                    "key_message_id": message_id,
+                    "key_to_id": to_id,
+                    "key_from_id": from_id,
+                }
+                for message_id, to_id, from_id in broken[index : index + BATCH_SIZE]
+            ],
+        )
+
+    subscribers = get_subscribers(session)
+    found_at = datetime.now()
+    orphans = []
+    for path, size in report.orphans:
+        subscriber = subscribers.get(get_chat_name(path))
+        orphans.append(
+            {
+                "path": path,
+                "subscriber_chat_id": getattr(subscriber, "chat_id", None),
+                "subscriber_chat_type": getattr(subscriber, "chat_type", None),
+                "size": size,
+                "sha256": report.hashes.get(path),
+                "found_at": found_at,
+            }
+        )
+
+    session.execute(delete(OrphanFile))
+    for index in range(0, len(orphans), BATCH_SIZE):
+        session.connection().execute(
+            insert(OrphanFile), orphans[index : index + BATCH_SIZE]
+        )
+
+
+def reindex_storage(session, workers):
+    """Rebuild the sizes of files and the storage counters of all chats from disk.
+
+    Returns the amount of files, whose size has been filled in.
+    """
+    storage = scan_storage(config["download"]["target_dir"], workers)
+
+    # Files from before sizes were stored.
+    result = session.execute(
+        select(File.message_id, File.to_id, File.from_id, File.file_path).where(
+            File.size.is_(None)
+        )
+    )
+    sizes = [
+        {
+            "key_message_id": message_id,
+            "key_to_id": to_id,
+            "key_from_id": from_id,
+            "size": storage[path],
+        }
+        for message_id, to_id, from_id, path in result
+        if path in storage
+    ]
+    statement = (
+        update(File)
+        .where(File.message_id == bindparam("key_message_id"))
+        .where(File.to_id == bindparam("key_to_id"))
+        .where(File.from_id == bindparam("key_from_id"))
+        .values(size=bindparam("size"))
+        .execution_options(synchronize_session=False)
+    )
+    for index in range(0, len(sizes), BATCH_SIZE):
+        session.connection().execute(statement, sizes[index : index + BATCH_SIZE])
+
+    # Everything on disk plus the reserved sizes of downloads, that haven't finished yet.
+    used_bytes = {}
+    for path, size in storage.items():
+        chat_name = get_chat_name(path)
+        used_bytes[chat_name] = used_bytes.get(chat_name, 0) + size
+
+    # Files, which have been given up, don't count towards the quota.
+    result = session.execute(
+        select(Subscriber.chat_name, File.file_path, File.size)
+        .join(File.subscriber)
+        .where(File.success.is_(False))
+        .where(File.attempts < config["download"]["max_attempts"])
+    )
+    for chat_name, path, size in result:
+        if not storage.get(path):
+            used_bytes[chat_name] = used_bytes.get(chat_name, 0) + (size or 0)
+
+    for chat_name, subscriber in get_subscribers(session).items():
+        subscriber.used_bytes = used_bytes.get(chat_name, 0)
+
+    return len(sizes)
+
+
+def get_chat_name(path):
+    """Get the name of the chat directory, which contains a path."""
+    return os.path.relpath(path, config["download"]["target_dir"]).split(os.sep)[0]
+
+
+def get_subscribers(session):
+    """Get all subscribers by the name of their chat directory."""
+    result = session.execute(select(Subscriber))
+    return {subscriber.chat_name: subscriber for subscriber in result.scalars()}
+
+
+def verify(rehash, workers):
+    """Check the archive without changing anything and return the report."""
+    with Session(engine) as session:
+        return check_storage(session, rehash, workers)
+
+
+def reconcile(rehash, workers):
+    """Check the archive, fix the database and return the report."""
+    with Session(engine) as session:
+        report = check_storage(session, rehash, workers)
+        apply_report(session, report)
+        blobs = delete_unreferenced_blobs(session)
+        session.commit()
+
+    report.removed_blobs = len(blobs)
+    report.freed_bytes = remove_blob_files(blobs)
+    return report
+
+
+def reindex(workers):
+    """Rebuild the sizes and storage counters. Returns the amount of filled in sizes."""
+    with Session(engine) as session:
+        count = reindex_storage(session, workers)
+        session.commit()
+
+    return count
@@ -0,0 +1,152 @@
+"""Prometheus metrics of the bot.
+
+The metrics are always collected, since that's cheap.
+They're only exported via http, if metrics are enabled in the config.
+"""
+import time
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    ProcessCollector,
+    start_http_server,
+)
+from sqlalchemy import event
+
+from archivebot.config import config
+
+# Buckets for the duration of file downloads and uploads in seconds.
+TRANSFER_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# Buckets for database queries and event handlers in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+
+
+class Metrics(object):
+    """All metrics of the bot in a registry of their own."""
+
+    def __init__(self):
+        """Create all metrics."""
+        self.registry = CollectorRegistry()
+        ProcessCollector(registry=self.registry)
+
+        self.events = Counter(
+            "archivebot_events",
+            "Events by handler and whether they have been handled or dropped.",
+            ["handler", "result"],
+            registry=self.registry,
+        )
+        self.handler_seconds = Histogram(
+            "archivebot_handler_seconds",
+            "Time spent in event handlers.",
+            ["handler"],
+            buckets=LATENCY_BUCKETS,
+            registry=self.registry,
+        )
+        self.step_seconds = Histogram(
+            "archivebot_step_seconds",
+            "Time spent in single steps of message processing.",
+            ["step"],
+            buckets=LATENCY_BUCKETS,
+            registry=self.registry,
+        )
+        self.db_seconds = Histogram(
+            "archivebot_db_seconds",
+            "Latency of database queries and commits.",
+            ["operation"],
+            buckets=LATENCY_BUCKETS,
+            registry=self.registry,
+        )
+
+        self.queue_depth = Gauge(
+            "archivebot_download_queue_depth",
+            "Downloads, which are waiting for a worker.",
+            registry=self.registry,
+        )
+        self.downloads_running = Gauge(
+            "archivebot_downloads_running",
+            "Downloads, which are currently running.",
+            registry=self.registry,
+        )
+        self.downloads = Counter(
+            "archivebot_downloads",
+            "Finished downloads by result.",
+            ["result"],
+            registry=self.registry,
+        )
+        self.download_bytes = Counter(
+            "archivebot_download_bytes",
+            "Bytes of successfully downloaded files.",
+            registry=self.registry,
+        )
+        self.download_seconds = Histogram(
+            "archivebot_download_seconds",
+            "Duration of single file downloads.",
+            buckets=TRANSFER_BUCKETS,
+            registry=self.registry,
+        )
+
+        self.blob_copies = Counter(
+            "archivebot_blob_copies",
+            "Deduplicated files, which have been copied, since hardlinks failed.",
+            registry=self.registry,
+        )
+
+        self.entity_lookups = Counter(
+            "archivebot_entity_lookups",
+            "Entity lookups by the source, that resolved them.",
+            ["source"],
+            registry=self.registry,
+        )
+        self.flood_waits = Counter(
+            "archivebot_flood_waits",
+            "Flood waits telegram imposed on us.",
+            registry=self.registry,
+        )
+        self.flood_wait_seconds = Counter(
+            "archivebot_flood_wait_seconds",
+            "Total seconds of all flood waits.",
+            registry=self.registry,
+        )
+
+        self.export_bytes = Counter(
+            "archivebot_export_bytes",
+            "Bytes of uploaded export volumes.",
+            registry=self.registry,
+        )
+        self.upload_seconds = Histogram(
+            "archivebot_upload_seconds",
+            "Duration of single volume uploads.",
+            buckets=TRANSFER_BUCKETS,
+            registry=self.registry,
+        )
+
+    def instrument_engine(self, engine):
+        """Measure the latency of all queries of a synchronous engine."""
+
+        # The start time is kept on the execution context. Failed queries never reach
+        # `after_cursor_execute`, but their start time is discarded with their context.
+        def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+            if context is not None:
+                context.query_start = time.perf_counter()
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+            start = getattr(context, "query_start", None)
+            if start is not None:
+                self.db_seconds.labels("query").observe(time.perf_counter() - start)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    def start(self):
+        """Start the http exporter, if metrics are enabled."""
+        if config["metrics"]["enabled"]:
+            start_http_server(
+                config["metrics"]["port"],
+                addr=config["metrics"]["address"],
+                registry=self.registry,
+            )
+
+
+metrics = Metrics()
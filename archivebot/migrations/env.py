@@ -0,0 +1,22 @@
+"""Run schema migrations against the configured database."""
+from alembic import context
+
+from archivebot.db import base, engine
+from archivebot.models import *  # noqa
+
+
+def run_migrations():
+    """Run all pending migrations with the synchronous engine."""
+    with engine.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=base.metadata,
+            # SQLite can't alter columns, the tables are recreated instead.
+            render_as_batch=True,
+        )
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+run_migrations()
@@ -0,0 +1,52 @@
+"""The initial schema.
+
+Revision ID: 0001
+Revises:
+Create Date: 2022-11-01 00:00:00
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "subscriber",
+        sa.Column("chat_id", sa.String(), nullable=False),
+        sa.Column("chat_type", sa.String(), nullable=False),
+        sa.Column("chat_name", sa.String(), nullable=False),
+        sa.Column("accepted_media", sa.String(), nullable=False),
+        sa.Column("allow_duplicates", sa.Boolean(), nullable=False),
+        sa.Column("active", sa.Boolean(), nullable=False),
+        sa.Column("verbose", sa.Boolean(), nullable=False),
+        sa.Column("sort_by_user", sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint("chat_id", "chat_type"),
+    )
+    op.create_table(
+        "file",
+        sa.Column("message_id", sa.Integer(), nullable=False),
+        sa.Column("to_id", sa.Integer(), nullable=False),
+        sa.Column("from_id", sa.Integer(), nullable=False),
+        sa.Column("to_type", sa.String(), nullable=False),
+        sa.Column("file_id", sa.String(), nullable=False),
+        sa.Column("file_type", sa.String(), nullable=False),
+        sa.Column("file_name", sa.String(), nullable=False),
+        sa.Column("file_path", sa.String(), nullable=False),
+        sa.Column("success", sa.Boolean(), nullable=False),
+        sa.Column("subscriber_chat_id", sa.Integer(), nullable=True),
+        sa.Column("subscriber_chat_type", sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["subscriber_chat_id", "subscriber_chat_type"],
+            ["subscriber.chat_id", "subscriber.chat_type"],
+        ),
+        sa.PrimaryKeyConstraint("message_id", "to_id", "from_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("file")
+    op.drop_table("subscriber")
@@ -0,0 +1,57 @@
+"""Add scan, retry and export state, the user cache and the blob store.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2022-11-02 00:00:00
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("subscriber") as batch_op:
+        batch_op.add_column(sa.Column("scan_filter", sa.String(), nullable=True))
+        batch_op.add_column(sa.Column("scan_offset_id", sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column("exported_at", sa.DateTime(), nullable=True))
+
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.add_column(sa.Column("downloaded_at", sa.DateTime(), nullable=True))
+        batch_op.add_column(
+            sa.Column("attempts", sa.Integer(), nullable=False, server_default="0")
+        )
+
+    op.create_table(
+        "cached_user",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("username", sa.String(), nullable=True),
+        sa.Column("first_name", sa.String(), nullable=True),
+        sa.Column("last_name", sa.String(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "blob",
+        sa.Column("media_id", sa.String(), nullable=False),
+        sa.Column("sha256", sa.String(), nullable=False),
+        sa.Column("size", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("media_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("blob")
+    op.drop_table("cached_user")
+
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.drop_column("attempts")
+        batch_op.drop_column("downloaded_at")
+
+    with op.batch_alter_table("subscriber") as batch_op:
+        batch_op.drop_column("exported_at")
+        batch_op.drop_column("scan_offset_id")
+        batch_op.drop_column("scan_filter")
@@ -0,0 +1,117 @@
+"""Use integer telegram ids everywhere and add indexes for the file lookups.
+
+Duplicate files of a subscriber, which could be created by concurrent events,
+are removed, before the unique index is created. The first successful entry is kept.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2022-11-03 00:00:00
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("subscriber") as batch_op:
+        batch_op.alter_column(
+            "chat_id",
+            existing_type=sa.String(),
+            type_=sa.BigInteger(),
+            postgresql_using="chat_id::bigint",
+        )
+        batch_op.alter_column(
+            "scan_offset_id", existing_type=sa.Integer(), type_=sa.BigInteger()
+        )
+        batch_op.create_index("ix_subscriber_chat_name", ["chat_name"])
+
+    op.execute(
+        """
+        DELETE FROM file WHERE EXISTS (
+            SELECT 1 FROM file AS other
+            WHERE other.subscriber_chat_id = file.subscriber_chat_id
+            AND other.subscriber_chat_type = file.subscriber_chat_type
+            AND other.file_id = file.file_id
+            AND (
+                (other.success AND NOT file.success)
+                OR (
+                    other.success = file.success
+                    AND (other.message_id, other.to_id, other.from_id)
+                    < (file.message_id, file.to_id, file.from_id)
+                )
+            )
+        )
+        """
+    )
+
+    with op.batch_alter_table("file") as batch_op:
+        for column in ["message_id", "to_id", "from_id", "subscriber_chat_id"]:
+            batch_op.alter_column(
+                column, existing_type=sa.Integer(), type_=sa.BigInteger()
+            )
+        batch_op.alter_column(
+            "file_id",
+            existing_type=sa.String(),
+            type_=sa.BigInteger(),
+            postgresql_using="file_id::bigint",
+        )
+        batch_op.create_index(
+            "ix_file_subscriber_file_id",
+            ["subscriber_chat_id", "subscriber_chat_type", "file_id"],
+            unique=True,
+        )
+        batch_op.create_index(
+            "ix_file_subscriber_downloaded_at",
+            ["subscriber_chat_id", "subscriber_chat_type", "downloaded_at"],
+        )
+        batch_op.create_index("ix_file_file_id", ["file_id"])
+
+    with op.batch_alter_table("cached_user") as batch_op:
+        batch_op.alter_column("id", existing_type=sa.Integer(), type_=sa.BigInteger())
+
+    with op.batch_alter_table("blob") as batch_op:
+        batch_op.alter_column(
+            "media_id",
+            existing_type=sa.String(),
+            type_=sa.BigInteger(),
+            postgresql_using="media_id::bigint",
+        )
+        batch_op.alter_column("size", existing_type=sa.Integer(), type_=sa.BigInteger())
+        batch_op.create_index("ix_blob_sha256", ["sha256"])
+
+
+def downgrade():
+    with op.batch_alter_table("blob") as batch_op:
+        batch_op.drop_index("ix_blob_sha256")
+        batch_op.alter_column("size", existing_type=sa.BigInteger(), type_=sa.Integer())
+        batch_op.alter_column(
+            "media_id", existing_type=sa.BigInteger(), type_=sa.String()
+        )
+
+    with op.batch_alter_table("cached_user") as batch_op:
+        batch_op.alter_column("id", existing_type=sa.BigInteger(), type_=sa.Integer())
+
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.drop_index("ix_file_file_id")
+        batch_op.drop_index("ix_file_subscriber_downloaded_at")
+        batch_op.drop_index("ix_file_subscriber_file_id")
+        batch_op.alter_column(
+            "file_id", existing_type=sa.BigInteger(), type_=sa.String()
+        )
+        for column in ["message_id", "to_id", "from_id", "subscriber_chat_id"]:
+            batch_op.alter_column(
+                column, existing_type=sa.BigInteger(), type_=sa.Integer()
+            )
+
+    with op.batch_alter_table("subscriber") as batch_op:
+        batch_op.drop_index("ix_subscriber_chat_name")
+        batch_op.alter_column(
+            "scan_offset_id", existing_type=sa.BigInteger(), type_=sa.Integer()
+        )
+        batch_op.alter_column(
+            "chat_id", existing_type=sa.BigInteger(), type_=sa.String()
+        )
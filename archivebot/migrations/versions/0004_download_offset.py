@@ -0,0 +1,27 @@
+"""Store the progress of chunked downloads.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2022-11-04 00:00:00
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.add_column(
+            sa.Column(
+                "download_offset", sa.BigInteger(), nullable=False, server_default="0"
+            )
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.drop_column("download_offset")
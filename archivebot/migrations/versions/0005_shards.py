@@ -0,0 +1,31 @@
+"""Assign chats to shards and claim downloads.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2022-11-11 00:00:00
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("subscriber") as batch_op:
+        batch_op.add_column(sa.Column("shard", sa.String(), nullable=True))
+
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.add_column(sa.Column("claimed_by", sa.String(), nullable=True))
+        batch_op.add_column(sa.Column("claimed_at", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.drop_column("claimed_at")
+        batch_op.drop_column("claimed_by")
+
+    with op.batch_alter_table("subscriber") as batch_op:
+        batch_op.drop_column("shard")
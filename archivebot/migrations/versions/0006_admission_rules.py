@@ -0,0 +1,47 @@
+"""Add admission rules and a storage counter to subscribers.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2022-11-14 00:00:00
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("subscriber") as batch_op:
+        batch_op.add_column(sa.Column("max_file_size", sa.BigInteger(), nullable=True))
+        batch_op.add_column(
+            sa.Column(
+                "allowed_mime_types", sa.String(), nullable=False, server_default=""
+            )
+        )
+        batch_op.add_column(
+            sa.Column(
+                "denied_mime_types", sa.String(), nullable=False, server_default=""
+            )
+        )
+        batch_op.add_column(sa.Column("quota", sa.BigInteger(), nullable=True))
+        batch_op.add_column(
+            sa.Column("used_bytes", sa.BigInteger(), nullable=False, server_default="0")
+        )
+
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.add_column(sa.Column("size", sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.drop_column("size")
+
+    with op.batch_alter_table("subscriber") as batch_op:
+        batch_op.drop_column("used_bytes")
+        batch_op.drop_column("quota")
+        batch_op.drop_column("denied_mime_types")
+        batch_op.drop_column("allowed_mime_types")
+        batch_op.drop_column("max_file_size")
@@ -0,0 +1,30 @@
+"""Register files on disk, which aren't known to the database.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2022-11-18 00:00:00
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "orphan_file",
+        sa.Column("path", sa.String(), nullable=False),
+        sa.Column("subscriber_chat_id", sa.BigInteger(), nullable=True),
+        sa.Column("subscriber_chat_type", sa.String(), nullable=True),
+        sa.Column("size", sa.BigInteger(), nullable=False),
+        sa.Column("sha256", sa.String(), nullable=True),
+        sa.Column("found_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("path"),
+    )
+
+
+def downgrade():
+    op.drop_table("orphan_file")
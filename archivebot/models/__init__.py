@@ -1,2 +1,5 @@
+from .blob import Blob  # noqa
 from .file import File  # noqa
+from .orphan import OrphanFile  # noqa
 from .subscriber import Subscriber  # noqa
+from .user import CachedUser  # noqa
@@ -0,0 +1,23 @@
+"""The model for a blob in the content-addressed store."""
+from sqlalchemy import BigInteger, Column, String
+
+from archivebot.db import base
+
+
+class Blob(base):
+    """Map a telegram media id to the content of the file.
+
+    Different media ids might point to the same content.
+    """
+
+    __tablename__ = "blob"
+
+    media_id = Column(BigInteger, primary_key=True)
+    sha256 = Column(String, nullable=False, index=True)
+    size = Column(BigInteger, nullable=False)
+
+    def __init__(self, media_id, sha256, size):
+        """Create a new blob."""
+        self.media_id = media_id
+        self.sha256 = sha256
+        self.size = size
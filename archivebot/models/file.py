@@ -1,5 +1,15 @@
 """The model for a file."""
-from sqlalchemy import Boolean, Column, ForeignKeyConstraint, Integer, String
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKeyConstraint,
+    Index,
+    Integer,
+    String,
+    select,
+)
 from sqlalchemy.orm import relationship
 
 from archivebot.db import base
@@ -14,20 +24,47 @@ class File(base):
             ["subscriber_chat_id", "subscriber_chat_type"],
             ["subscriber.chat_id", "subscriber.chat_type"],
         ),
+        # Duplicate checks and scans look up media ids per subscriber.
+        Index(
+            "ix_file_subscriber_file_id",
+            "subscriber_chat_id",
+            "subscriber_chat_type",
+            "file_id",
+            unique=True,
+        ),
+        # Incremental exports fetch the files of a subscriber by download time.
+        Index(
+            "ix_file_subscriber_downloaded_at",
+            "subscriber_chat_id",
+            "subscriber_chat_type",
+            "downloaded_at",
+        ),
+        Index("ix_file_file_id", "file_id"),
     )
 
-    message_id = Column(Integer, primary_key=True)
-    to_id = Column(Integer, primary_key=True)
-    from_id = Column(Integer, primary_key=True)
+    # Telegram ids are 64 bit integers.
+    message_id = Column(BigInteger, primary_key=True)
+    to_id = Column(BigInteger, primary_key=True)
+    from_id = Column(BigInteger, primary_key=True)
     to_type = Column(String, nullable=False)
-    file_id = Column(String, nullable=False)
+    file_id = Column(BigInteger, nullable=False)
     file_type = Column(String, nullable=False)
     file_name = Column(String, nullable=False)
     file_path = Column(String, nullable=False)
     success = Column(Boolean, nullable=False, default=False)
+    downloaded_at = Column(DateTime)
+    # Amount of failed download attempts, that will be retried.
+    attempts = Column(Integer, nullable=False, default=0)
+    # The part of a chunked download, which is already on disk.
+    download_offset = Column(BigInteger, nullable=False, default=0)
+    # The size of the media according to telegram. It's counted towards the quota.
+    size = Column(BigInteger)
+    # The bot process, which is currently downloading this file, and when it claimed it.
+    claimed_by = Column(String)
+    claimed_at = Column(DateTime)
 
     subscriber = relationship("Subscriber", back_populates="files")
-    subscriber_chat_id = Column(Integer)
+    subscriber_chat_id = Column(BigInteger)
     subscriber_chat_type = Column(String)
 
     def __init__(
@@ -41,6 +78,7 @@ class File(base):
         file_type,
         file_name,
         file_path,
+        size=None,
     ):
         """Create a new file."""
         self.file_id = file_id
@@ -51,14 +89,43 @@ class File(base):
         self.file_type = file_type
         self.file_name = file_name
         self.file_path = file_path
+        self.attempts = 0
+        self.download_offset = 0
+        self.size = size
 
         self.subscriber = subscriber
 
-    def exists(session, subscriber, file_id):
+    @staticmethod
+    async def exists(session, subscriber, file_id):
         """Check if we already have this file."""
-        return (
-            session.query(File)
-            .filter(File.file_id == file_id)
-            .filter(File.subscriber == subscriber)
-            .one_or_none()
+        result = await session.execute(
+            select(File)
+            .where(File.file_id == file_id)
+            .where(File.subscriber == subscriber)
+        )
+        return result.scalars().one_or_none()
+
+    @staticmethod
+    async def get_downloaded_since(session, subscriber, since):
+        """Get all successfully downloaded files of a subscriber since a given time."""
+        query = (
+            select(File)
+            .where(File.subscriber == subscriber)
+            .where(File.success.is_(True))
         )
+        if since is not None:
+            query = query.where(File.downloaded_at > since)
+
+        result = await session.execute(query.order_by(File.downloaded_at))
+        return result.scalars().all()
+
+    @staticmethod
+    async def get_known_file_ids(session, subscriber, file_ids):
+        """Return the subset of the given file ids, which are already known."""
+        result = await session.execute(
+            select(File.file_id)
+            .where(File.file_id.in_(file_ids))
+            .where(File.subscriber == subscriber)
+        )
+
+        return set(result.scalars().all())
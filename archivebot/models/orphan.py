@@ -0,0 +1,35 @@
+"""The model for a file on disk, which isn't known to the database."""
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Column, DateTime, String
+
+from archivebot.db import base
+
+
+class OrphanFile(base):
+    """A file in the target directory without a matching file entry.
+
+    Orphans are registered by `main.py reconcile`, e.g. after files have been copied
+    into a chat directory by hand or after a crash. They are counted towards the quota of their chat.
+    """
+
+    __tablename__ = "orphan_file"
+
+    path = Column(String, primary_key=True)
+    # The subscriber, whose chat directory contains the file. None, if there's no such chat.
+    subscriber_chat_id = Column(BigInteger)
+    subscriber_chat_type = Column(String)
+    size = Column(BigInteger, nullable=False)
+    # Only known, if the file has been hashed with `--rehash`.
+    sha256 = Column(String)
+    found_at = Column(DateTime, nullable=False, default=datetime.now)
+
+    def __init__(self, path, subscriber, size, sha256=None):
+        """Create a new orphan."""
+        self.path = path
+        if subscriber is not None:
+            self.subscriber_chat_id = subscriber.chat_id
+            self.subscriber_chat_type = subscriber.chat_type
+        self.size = size
+        self.sha256 = sha256
+        self.found_at = datetime.now()
@@ -1,5 +1,5 @@
 """The model for a subscriber."""
-from sqlalchemy import Boolean, Column, String
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Index, String
 from sqlalchemy.orm import relationship
 
 from archivebot.db import base
@@ -9,8 +9,9 @@ class Subscriber(base):
     """The model for a subscriber."""
 
     __tablename__ = "subscriber"
+    __table_args__ = (Index("ix_subscriber_chat_name", "chat_name"),)
 
-    chat_id = Column(String, primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     chat_type = Column(String, primary_key=True)
     chat_name = Column(String, nullable=False)
     accepted_media = Column(String, nullable=False, default="")
@@ -19,17 +20,40 @@ class Subscriber(base):
     verbose = Column(Boolean, nullable=False, default=False)
     sort_by_user = Column(Boolean(), nullable=False, default=True)
 
+    # The state of an unfinished /scan_chat.
+    # The name of the current filter pass and the id of the last scanned message.
+    scan_filter = Column(String)
+    scan_offset_id = Column(BigInteger)
+
+    # The time of the last /zip. Incremental exports contain all files downloaded afterwards.
+    exported_at = Column(DateTime)
+
+    # The name of the shard, which archives this chat. Any shard may archive it, if it's None.
+    shard = Column(String)
+
+    # Admission rules for new files. Sizes are in bytes, None means unlimited.
+    # Mime types are space separated patterns like `video/*`.
+    max_file_size = Column(BigInteger)
+    allowed_mime_types = Column(String, nullable=False, default="")
+    denied_mime_types = Column(String, nullable=False, default="")
+    quota = Column(BigInteger)
+    # The size of all files of this chat. It's updated with every new or removed file.
+    used_bytes = Column(BigInteger, nullable=False, default=0)
+
     files = relationship("File")
 
     def __init__(self, chat_id, chat_type, chat_name=None, accepted_media="document"):
         """Create a new subscriber."""
         self.chat_id = chat_id
         self.chat_type = chat_type
-        self.chat_name = chat_name or chat_id
+        self.chat_name = chat_name or str(chat_id)
         self.accepted_media = accepted_media
+        self.allowed_mime_types = ""
+        self.denied_mime_types = ""
+        self.used_bytes = 0
 
     @staticmethod
-    def get_or_create(session, chat_id, chat_type, message, chat_name=None):
+    async def get_or_create(session, chat_id, chat_type, message, chat_name=None):
         """Get or create a new subscriber."""
         # If we have a user chat, we use the combination of both member ids to compile our own
         # unique identifier for this chat, since telegram doesn't give us a unique chat id for user chats.
@@ -38,10 +62,11 @@ class Subscriber(base):
             identifier.sort()
             identifier = "_".join(identifier)
 
-        subscriber = session.query(Subscriber).get((chat_id, chat_type))
+        subscriber = await session.get(Subscriber, (chat_id, chat_type))
         if not subscriber:
             subscriber = Subscriber(chat_id, chat_type, chat_name=chat_name)
             session.add(subscriber)
-            session.commit()
+            # The subscriber is committed together with the rest of the event.
+            await session.flush()
 
         return subscriber
@@ -0,0 +1,33 @@
+"""The model for a cached telegram user."""
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Column, DateTime, String
+
+from archivebot.db import base
+
+
+class CachedUser(base):
+    """A telegram user, which has been resolved before.
+
+    This allows to resolve users without any network requests, even after a restart.
+    """
+
+    __tablename__ = "cached_user"
+
+    id = Column(BigInteger, primary_key=True)
+    username = Column(String)
+    first_name = Column(String)
+    last_name = Column(String)
+    updated_at = Column(DateTime, nullable=False, default=datetime.now)
+
+    def __init__(self, user):
+        """Create a new cached user from a telegram user."""
+        self.id = user.id
+        self.update(user)
+
+    def update(self, user):
+        """Update the cached user with the data of a telegram user."""
+        self.username = user.username
+        self.first_name = user.first_name
+        self.last_name = user.last_name
+        self.updated_at = datetime.now()
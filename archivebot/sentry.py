@@ -1,6 +1,4 @@
 """Simple wrapper around sentry that allows for lazy initilization."""
-from raven import Client
-
 from archivebot.config import config
 
 
@@ -15,6 +13,9 @@ class Sentry(object):
     def __init__(self):
         """Construct new sentry wrapper."""
         if config["logging"]["sentry_enabled"]:
+            # Raven is slow to import. Only pay for it, if it's actually used.
+            from raven import Client
+
             self.initialized = True
             self.sentry = Client(config["logging"]["sentry_token"])
 
@@ -0,0 +1,21 @@
+"""Storage backends, into which the files of all chats are archived."""
+from archivebot.config import config
+from archivebot.storage.base import Storage  # noqa
+from archivebot.storage.local import LocalStorage
+
+
+def create_storage():
+    """Create the storage backend from the config."""
+    backend = config["storage"]["backend"]
+    if backend == "local":
+        return LocalStorage(config["download"]["target_dir"])
+    elif backend == "s3":
+        # boto3 is an optional dependency. Only require it, if it's actually used.
+        from archivebot.storage.s3 import S3Storage
+
+        return S3Storage(config["storage"])
+
+    raise Exception(f"Unknown storage backend {backend}")
+
+
+storage = create_storage()
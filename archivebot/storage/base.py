@@ -0,0 +1,75 @@
+"""The interface of all storage backends."""
+
+
+class Storage(object):
+    """A place, where the files of all chats are archived.
+
+    Files are identified by their path, which is stored in the file table.
+    For the local backend this is a path on disk, for S3 the key of an object.
+    """
+
+    # Whether files are written to the local file system by the download workers.
+    # Otherwise the backend downloads files by itself.
+    is_local = False
+
+    def start(self):
+        """Start any background work of the backend. Called once the bot is running."""
+
+    def get_chat_path(self, chat_name):
+        """Get the path, under which all files of a chat are stored."""
+        raise NotImplementedError
+
+    async def reserve(self, chat_name, directory, file_name, allow_duplicates):
+        """Reserve a unique path for a new file in an optional subdirectory of a chat.
+
+        If the name is taken, the next free suffix is used, unless duplicates are disallowed.
+        Returns the path and the reserved name. The path is None, if nothing has been reserved.
+        """
+        raise NotImplementedError
+
+    async def release(self, path):
+        """Give up a reserved path, whose file won't be downloaded anymore."""
+        raise NotImplementedError
+
+    async def download(self, job):
+        """Download the media of a job into its path. Returns the path or None."""
+        raise NotImplementedError
+
+    async def exists(self, path):
+        """Check whether a file has been stored completely."""
+        raise NotImplementedError
+
+    async def get_size(self, path):
+        """Get the size of a stored file."""
+        raise NotImplementedError
+
+    async def get_modified(self, path):
+        """Get the local time, at which a stored file has been written."""
+        raise NotImplementedError
+
+    async def chat_exists(self, chat_name):
+        """Check whether any files of a chat are stored."""
+        raise NotImplementedError
+
+    async def move_chat(self, old_name, new_name):
+        """Move all files of a chat to a new chat name."""
+        raise NotImplementedError
+
+    async def remove_chat(self, chat_name):
+        """Remove all files of a chat."""
+        raise NotImplementedError
+
+    def iter_chat_files(self, chat_name):
+        """Yield the path and archive name of all files of a chat.
+
+        This and the following methods block and are only used from executor threads.
+        """
+        raise NotImplementedError
+
+    def iter_existing_files(self, chat_name, paths):
+        """Yield the path and archive name of the given files, if they still exist."""
+        raise NotImplementedError
+
+    def add_to_archive(self, archive, path, name):
+        """Add a stored file to a tar archive."""
+        raise NotImplementedError
@@ -0,0 +1,268 @@
+"""Archive files in the target directory on the local file system.
+
+Every file system call runs in the file system threads, see `archivebot.helper.filesystem`.
+"""
+import asyncio
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from archivebot.config import config
+from archivebot.helper.filesystem import filesystem
+from archivebot.storage.base import Storage
+
+# Only a single cleanup of the trash directory runs at a time.
+trash_lock = asyncio.Lock()
+# References to running background tasks, so they aren't garbage collected.
+background_tasks = set()
+
+
+class LocalStorage(Storage):
+    """Store files in a directory per chat, e.g. `{target_dir}/{chat}/{user}/{file}`."""
+
+    is_local = True
+
+    def __init__(self, target_dir):
+        """Create the backend for the given target directory."""
+        self.target_dir = target_dir
+
+    def start(self):
+        """Remove directories, which were left in the trash during the last shutdown."""
+        schedule_trash_cleanup()
+
+    def get_chat_path(self, chat_name):
+        """Compile the directory path for this chat."""
+        return os.path.join(self.target_dir, chat_name)
+
+    async def reserve(self, chat_name, directory, file_name, allow_duplicates):
+        """Reserve the file name in its directory. The name is a new empty file afterwards."""
+        path = self.get_chat_path(chat_name)
+        if directory is not None:
+            path = os.path.join(path, directory)
+
+        reserved_name = await filesystem.run(
+            name_index.reserve, path, file_name, allow_duplicates
+        )
+        if reserved_name is None:
+            return None, file_name
+
+        return os.path.join(path, reserved_name), reserved_name
+
+    async def release(self, path):
+        """Remove the placeholder or partial download of a file and free its name."""
+        await filesystem.run(name_index.release, path)
+
+    async def exists(self, path):
+        """Check whether a file exists on disk."""
+        return await filesystem.run(os.path.isfile, path)
+
+    async def get_size(self, path):
+        """Get the size of a file on disk."""
+        return await filesystem.getsize(path)
+
+    async def get_modified(self, path):
+        """Get the modification time of a file on disk."""
+        return datetime.fromtimestamp(await filesystem.run(os.path.getmtime, path))
+
+    async def chat_exists(self, chat_name):
+        """Check whether the directory of a chat exists."""
+        return await filesystem.exists(self.get_chat_path(chat_name))
+
+    async def move_chat(self, old_name, new_name):
+        """Move the directory of a chat to a new name, if it exists."""
+        old_path = self.get_chat_path(old_name)
+        new_path = self.get_chat_path(new_name)
+        if not await filesystem.exists(old_path):
+            return
+
+        await filesystem.rename(old_path, new_path)
+        await filesystem.run(name_index.forget, old_path)
+        await filesystem.run(name_index.forget, new_path)
+
+    async def remove_chat(self, chat_name):
+        """Move the directory of a chat into the trash. It's deleted in the background."""
+        await move_to_trash(self.get_chat_path(chat_name))
+        schedule_trash_cleanup()
+
+    def iter_chat_files(self, chat_name):
+        """Yield the path and archive name of all files in a chat directory."""
+        chat_path = self.get_chat_path(chat_name)
+        for root, dirs, files in os.walk(chat_path):
+            dirs.sort()
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                yield path, os.path.relpath(path, self.target_dir)
+
+    def iter_existing_files(self, chat_name, paths):
+        """Yield the path and archive name of the given files, if they still exist."""
+        for path in paths:
+            if os.path.exists(path):
+                yield path, os.path.relpath(path, self.target_dir)
+
+    def add_to_archive(self, archive, path, name):
+        """Add a file on disk to a tar archive."""
+        archive.add(path, arcname=name)
+
+
+def get_trash_dir():
+    """Get the directory, in which removed directories wait for their deletion."""
+    return os.path.join(config["download"]["target_dir"], ".trash")
+
+
+async def move_to_trash(path):
+    """Move a directory into the trash directory.
+
+    The rename is atomic, since the trash directory lives on the same file system.
+    """
+    if not await filesystem.exists(path):
+        return
+
+    trash_dir = get_trash_dir()
+    await filesystem.makedirs(trash_dir)
+    await filesystem.rename(path, os.path.join(trash_dir, uuid.uuid4().hex))
+    await filesystem.run(name_index.forget, path)
+
+
+def empty_trash():
+    """Delete everything in the trash directory."""
+    trash_dir = get_trash_dir()
+    if not os.path.exists(trash_dir):
+        return
+
+    for entry in os.scandir(trash_dir):
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+async def clear_trash():
+    """Empty the trash directory in the background, so the event loop isn't blocked."""
+    async with trash_lock:
+        await filesystem.run(empty_trash)
+
+
+def schedule_trash_cleanup():
+    """Empty the trash directory in the background."""
+    task = asyncio.get_running_loop().create_task(clear_trash())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+class DirectoryNames(object):
+    """The taken file names of a single directory."""
+
+    def __init__(self, directory):
+        """Create the directory if necessary and read all existing names at once."""
+        os.makedirs(directory, exist_ok=True)
+        with os.scandir(directory) as entries:
+            self.names = {entry.name for entry in entries}
+        # The last suffix, which has been handed out for a file name.
+        self.suffixes = {}
+
+    def next_name(self, file_name):
+        """Get the next free name with a suffix, e.g. `name_2.ext`."""
+        stem, extension = os.path.splitext(file_name)
+        counter = self.suffixes.get(file_name, 0)
+        while True:
+            counter += 1
+            candidate = f"{stem}_{counter}{extension}"
+            if candidate not in self.names:
+                self.suffixes[file_name] = counter
+                return candidate
+
+
+class NameIndex(object):
+    """Allocate unique file names without probing the file system for each candidate.
+
+    The names of a directory are read once with a single scandir.
+    Afterwards, free names are looked up in memory. Names are reserved
+    by creating an empty file with O_EXCL, so no existing file is ever overwritten.
+    The index is used from the file system threads, so every access holds a lock.
+    """
+
+    def __init__(self, size):
+        """Create a new index, which remembers up to `size` directories."""
+        self.size = size
+        self.directories = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_names(self, directory):
+        """Get the names of a directory. Read them, if the directory isn't known yet."""
+        names = self.directories.get(directory)
+        if names is None:
+            names = DirectoryNames(directory)
+            self.directories[directory] = names
+            if len(self.directories) > self.size:
+                self.directories.popitem(last=False)
+
+        self.directories.move_to_end(directory)
+        return names
+
+    def reserve(self, directory, file_name, allow_duplicates):
+        """Reserve a file name in a directory.
+
+        If the name is taken, the next free suffix is used, unless duplicates are disallowed.
+        Returns the reserved name or None.
+        """
+        with self.lock:
+            return self.reserve_locked(directory, file_name, allow_duplicates)
+
+    def reserve_locked(self, directory, file_name, allow_duplicates):
+        """Reserve a file name in a directory, while the lock is held."""
+        names = self.get_names(directory)
+
+        candidate = file_name
+        if candidate in names.names:
+            if not allow_duplicates:
+                return None
+            candidate = names.next_name(file_name)
+
+        while True:
+            try:
+                flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+                os.close(os.open(os.path.join(directory, candidate), flags))
+            except FileExistsError:
+                # The file has been created by somebody else in the meantime.
+                names.names.add(candidate)
+                if not allow_duplicates:
+                    return None
+                candidate = names.next_name(file_name)
+                continue
+            except FileNotFoundError:
+                # The directory has been moved or removed in the meantime.
+                # Start over with the names of the new directory.
+                self.forget_locked(directory)
+                return self.reserve_locked(directory, file_name, allow_duplicates)
+
+            names.names.add(candidate)
+            return candidate
+
+    def release(self, path):
+        """Remove a reserved file and the part file of its chunked download and free its name."""
+        directory, name = os.path.split(path)
+        with self.lock:
+            for file_path in [path, f"{path}.part"]:
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+
+            names = self.directories.get(directory)
+            if names is not None:
+                names.names.discard(name)
+
+    def forget(self, path):
+        """Forget a directory and all of its subdirectories, e.g. after it has been moved."""
+        with self.lock:
+            self.forget_locked(path)
+
+    def forget_locked(self, path):
+        """Forget a directory and all of its subdirectories, while the lock is held."""
+        prefix = os.path.join(path, "")
+        for directory in list(self.directories):
+            if directory == path or directory.startswith(prefix):
+                del self.directories[directory]
+
+
+name_index = NameIndex(config["download"]["name_index_size"])
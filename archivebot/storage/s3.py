@@ -0,0 +1,274 @@
+"""Archive files into an S3 compatible bucket, e.g. of a MinIO server on the same host.
+
+Media is streamed from telegram into a multipart upload. The bytes never touch the local disk.
+All calls of the S3 client block and run in the file system threads.
+"""
+import asyncio
+import os
+import tarfile
+
+from archivebot.helper.export import parse_size
+from archivebot.helper.filesystem import filesystem
+from archivebot.storage.base import Storage
+
+# S3 doesn't accept smaller parts, except for the last one.
+MIN_PART_SIZE = 5 * 1024**2
+# Telegram doesn't allow requests larger than 512kb.
+REQUEST_SIZE = 512 * 1024
+# The maximum amount of keys, which can be deleted with a single request.
+DELETE_BATCH_SIZE = 1000
+
+
+class S3Storage(Storage):
+    """Store files as objects with keys like `{prefix}{chat}/{user}/{file}`."""
+
+    def __init__(self, options):
+        """Create the backend. The client is only created on first use."""
+        self.options = options
+        self.bucket = options["s3_bucket"]
+        self.prefix = options["s3_prefix"]
+        self.part_size = max(parse_size(options["s3_part_size"]), MIN_PART_SIZE)
+        self.client = None
+        # Keys, which have been handed out, but whose upload hasn't finished yet.
+        self.reserved = set()
+
+    def get_client(self):
+        """Get the S3 client. Clients are thread-safe and shared by all threads."""
+        if self.client is None:
+            # boto3 is slow to import and optional.
+            import boto3
+
+            self.client = boto3.client(
+                "s3",
+                endpoint_url=self.options["s3_endpoint_url"] or None,
+                region_name=self.options["s3_region"] or None,
+                aws_access_key_id=self.options["s3_access_key"] or None,
+                aws_secret_access_key=self.options["s3_secret_key"] or None,
+            )
+
+        return self.client
+
+    async def call(self, method, **kwargs):
+        """Call a method of the S3 client without blocking the event loop."""
+        return await filesystem.run(getattr(self.get_client(), method), **kwargs)
+
+    def get_chat_path(self, chat_name):
+        """Get the key prefix of all files of a chat."""
+        return f"{self.prefix}{chat_name}"
+
+    def has_object(self, key):
+        """Check whether an object exists."""
+        try:
+            self.get_client().head_object(Bucket=self.bucket, Key=key)
+        except self.get_client().exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["404", "NoSuchKey", "NotFound"]:
+                return False
+            raise
+
+        return True
+
+    def iter_keys(self, prefix):
+        """Yield the keys of all objects with the given prefix."""
+        paginator = self.get_client().get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"]
+
+    def delete_keys(self, keys):
+        """Delete objects in batches."""
+        keys = list(keys)
+        for index in range(0, len(keys), DELETE_BATCH_SIZE):
+            self.get_client().delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [
+                        {"Key": key} for key in keys[index : index + DELETE_BATCH_SIZE]
+                    ],
+                    "Quiet": True,
+                },
+            )
+
+    async def reserve(self, chat_name, directory, file_name, allow_duplicates):
+        """Find a free key for a new file.
+
+        The object is only created once its upload finishes. Until then, the key is
+        remembered in memory, so it isn't handed out twice.
+        """
+        path = self.get_chat_path(chat_name)
+        if directory is not None:
+            path = f"{path}/{directory}"
+
+        stem, extension = os.path.splitext(file_name)
+        candidate = file_name
+        counter = 0
+        while True:
+            key = f"{path}/{candidate}"
+            if key not in self.reserved:
+                self.reserved.add(key)
+                if not await filesystem.run(self.has_object, key):
+                    return key, candidate
+                self.reserved.discard(key)
+
+            if not allow_duplicates:
+                return None, file_name
+
+            counter += 1
+            candidate = f"{stem}_{counter}{extension}"
+
+    async def release(self, path):
+        """Hand out the key of a file, which won't be uploaded, again."""
+        self.reserved.discard(path)
+
+    async def upload_part(self, key, upload_id, number, data):
+        """Upload a single part of a multipart upload."""
+        response = await self.call(
+            "upload_part",
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=data,
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    async def download(self, job):
+        """Stream the media of a job into its object.
+
+        The media is uploaded in parts, while it's downloaded. The previous part is
+        uploaded, while the next one is downloaded, so at most two parts are in memory.
+        Files, which fit into a single part, are uploaded with a single request.
+        """
+        key = str(job.file_path)
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        pending = None
+        try:
+            async for chunk in job.message.client.iter_download(
+                job.message.media, request_size=REQUEST_SIZE
+            ):
+                buffer += chunk
+                if len(buffer) < self.part_size:
+                    continue
+
+                if upload_id is None:
+                    response = await self.call(
+                        "create_multipart_upload", Bucket=self.bucket, Key=key
+                    )
+                    upload_id = response["UploadId"]
+
+                if pending is not None:
+                    parts.append(await pending)
+                pending = asyncio.ensure_future(
+                    self.upload_part(key, upload_id, len(parts) + 1, bytes(buffer))
+                )
+                buffer = bytearray()
+
+            if upload_id is None:
+                await self.call(
+                    "put_object", Bucket=self.bucket, Key=key, Body=bytes(buffer)
+                )
+            else:
+                parts.append(await pending)
+                pending = None
+                if buffer:
+                    parts.append(
+                        await self.upload_part(
+                            key, upload_id, len(parts) + 1, bytes(buffer)
+                        )
+                    )
+
+                await self.call(
+                    "complete_multipart_upload",
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+        except BaseException:
+            if pending is not None:
+                pending.cancel()
+            # Don't leave the uploaded parts lying around in the bucket.
+            if upload_id is not None:
+                await self.call(
+                    "abort_multipart_upload",
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                )
+            raise
+        finally:
+            # Either the object exists now or the key can be handed out again.
+            self.reserved.discard(key)
+
+        return key
+
+    async def exists(self, path):
+        """Check whether an object exists. Objects only exist, once their upload finished."""
+        return await filesystem.run(self.has_object, path)
+
+    async def get_size(self, path):
+        """Get the size of an object."""
+        response = await self.call("head_object", Bucket=self.bucket, Key=path)
+        return response["ContentLength"]
+
+    async def get_modified(self, path):
+        """Get the local time, at which an object has been uploaded."""
+        response = await self.call("head_object", Bucket=self.bucket, Key=path)
+        return response["LastModified"].astimezone().replace(tzinfo=None)
+
+    async def chat_exists(self, chat_name):
+        """Check whether there are any objects of a chat."""
+        response = await self.call(
+            "list_objects_v2",
+            Bucket=self.bucket,
+            Prefix=f"{self.get_chat_path(chat_name)}/",
+            MaxKeys=1,
+        )
+        return response["KeyCount"] > 0
+
+    def move_keys(self, old_path, new_path):
+        """Copy all objects of a chat to the new prefix and delete the old ones."""
+        keys = list(self.iter_keys(f"{old_path}/"))
+        for key in keys:
+            self.get_client().copy(
+                {"Bucket": self.bucket, "Key": key},
+                self.bucket,
+                new_path + key[len(old_path) :],
+            )
+        self.delete_keys(keys)
+
+    async def move_chat(self, old_name, new_name):
+        """Move all objects of a chat. S3 can't rename, so every object is copied."""
+        await filesystem.run(
+            self.move_keys, self.get_chat_path(old_name), self.get_chat_path(new_name)
+        )
+
+    async def remove_chat(self, chat_name):
+        """Delete all objects of a chat."""
+        prefix = f"{self.get_chat_path(chat_name)}/"
+        await filesystem.run(lambda: self.delete_keys(self.iter_keys(prefix)))
+        self.reserved = {key for key in self.reserved if not key.startswith(prefix)}
+
+    def iter_chat_files(self, chat_name):
+        """Yield the key and archive name of all objects of a chat."""
+        for key in self.iter_keys(f"{self.get_chat_path(chat_name)}/"):
+            yield key, key[len(self.prefix) :]
+
+    def iter_existing_files(self, chat_name, paths):
+        """Yield the key and archive name of the given objects, if they still exist."""
+        for path in paths:
+            if self.has_object(path):
+                yield path, path[len(self.prefix) :]
+
+    def add_to_archive(self, archive, path, name):
+        """Stream an object into a tar archive."""
+        response = self.get_client().get_object(Bucket=self.bucket, Key=path)
+        info = tarfile.TarInfo(name)
+        info.size = response["ContentLength"]
+        info.mtime = response["LastModified"].timestamp()
+        body = response["Body"]
+        try:
+            archive.addfile(info, body)
+        finally:
+            body.close()
@@ -0,0 +1,230 @@
+#!/bin/env python
+"""Benchmark the live message path and the full chat scan without a telegram account.
+
+Every combination of path and database runs in a process of its own,
+with a temporary configuration, database and target directory.
+That way the peak memory of each run is measured separately.
+
+Run it from the repository root:
+
+    python benchmarks/bot.py run --messages 20000 --latency 0.01
+"""
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import toml
+import typer
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+# The channel, which is archived by the benchmark.
+CHAT_ID = 100
+# In-memory SQLite databases can't be shared between the connections of the pool.
+# A database on a tmpfs is used instead, which shows the cost without any disk io.
+MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+databases = {
+    "memory": "sqlite:///{memory_directory}/archivebot.db",
+    "file": "sqlite:///{directory}/archivebot.db",
+}
+paths = ["live", "scan"]
+
+cli = typer.Typer()
+
+
+def write_config(directory, memory_directory, database):
+    """Write the configuration for a benchmark run and use it for archivebot."""
+    config_path = os.path.join(directory, "archivebot.toml")
+    with open(config_path, "w") as file_descriptor:
+        toml.dump(
+            {
+                "telegram": {"app_api_id": 1, "app_api_hash": "benchmark"},
+                "database": {
+                    "sql_uri": databases[database].format(
+                        directory=directory, memory_directory=memory_directory
+                    )
+                },
+                "download": {
+                    "target_dir": os.path.join(directory, "files"),
+                    # Measure the bot itself instead of the configured scan throttling.
+                    "scan_rate": 0,
+                    "scan_rate_per_chat": 0,
+                },
+            },
+            file_descriptor,
+        )
+
+    # The config is loaded, once archivebot is imported.
+    # This takes precedence over an ARCHIVEBOT_CONFIG of the calling shell.
+    os.environ["ARCHIVEBOT_CONFIG"] = config_path
+    # The telegram session file is created in the working directory.
+    os.chdir(directory)
+
+
+async def subscribe(archivebot, client):
+    """Subscribe to the benchmark chat and accept all media types."""
+    from fake_telegram import FakeEvent, create_command
+
+    commands = [
+        (archivebot.start, "/start@archivebot"),
+        (archivebot.accepted_media_types, "/accept@archivebot document photo sticker"),
+    ]
+    for handler, text in commands:
+        await handler(FakeEvent(create_command(client, CHAT_ID, text), client))
+
+
+async def run_live(archivebot, client, messages):
+    """Process all messages as new message events. Return the processing time."""
+    from fake_telegram import FakeEvent
+
+    from archivebot.helper import process_filter
+
+    start = time.perf_counter()
+    for message in messages:
+        event = FakeEvent(message, client)
+        if process_filter(event):
+            await archivebot.process(event)
+
+    return time.perf_counter() - start
+
+
+async def run_scan(archivebot, client, messages):
+    """Scan the whole history of the chat. Return the processing time.
+
+    The scan only finishes, once all of its files have been downloaded.
+    """
+    from fake_telegram import FakeEvent, create_command
+
+    client.history = messages
+    start = time.perf_counter()
+    command = create_command(client, CHAT_ID, "/scan_chat@archivebot")
+    await archivebot.scan_chat(FakeEvent(command, client))
+
+    return time.perf_counter() - start
+
+
+async def run_benchmark(path, message_count, latency, flood_rate):
+    """Run a single benchmark and return its results."""
+    from fake_telegram import FakeTelegramClient, generate_messages
+    from sqlalchemy import event, func, select
+
+    import archivebot.archivebot as archivebot
+    from archivebot.db import async_engine, base, engine, get_session
+    from archivebot.helper.cache import subscriber_cache
+    from archivebot.helper.download import download_queue
+    from archivebot.models import File
+
+    base.metadata.create_all(bind=engine)
+
+    queries = 0
+
+    def count_query(*args):
+        nonlocal queries
+        queries += 1
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count_query)
+
+    client = FakeTelegramClient(latency=latency, flood_rate=flood_rate)
+    archivebot.archive = client
+    messages = generate_messages(client, message_count, CHAT_ID)
+
+    await subscriber_cache.preload()
+    await subscribe(archivebot, client)
+    download_queue.start(asyncio.get_running_loop())
+
+    queries = 0
+    start = time.perf_counter()
+    if path == "live":
+        processing = await run_live(archivebot, client, messages)
+    else:
+        processing = await run_scan(archivebot, client, messages)
+    processing_queries = queries
+
+    await download_queue.join((CHAT_ID, "channel"))
+    total = time.perf_counter() - start
+
+    async with get_session() as session:
+        files = await session.scalar(select(func.count()).select_from(File))
+
+    await async_engine.dispose()
+
+    return {
+        "messages": message_count,
+        "files": files,
+        "messages_per_second": message_count / processing,
+        "downloads_per_second": client.downloads / total,
+        "queries_per_message": processing_queries / message_count,
+        "flood_waits": client.flood_waits,
+        "seconds": total,
+        # Linux reports the peak resident memory in kilobytes.
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+@cli.command()
+def single(
+    path: str,
+    database: str,
+    messages: int = 10000,
+    latency: float = 0.005,
+    flood_rate: float = 0.0,
+):
+    """Run a single benchmark and print the results as json."""
+    sys.path.insert(0, BENCHMARK_DIR)
+    with tempfile.TemporaryDirectory() as directory:
+        with tempfile.TemporaryDirectory(dir=MEMORY_DIR) as memory_directory:
+            write_config(directory, memory_directory, database)
+            results = asyncio.run(run_benchmark(path, messages, latency, flood_rate))
+
+    typer.echo(json.dumps(results))
+
+
+@cli.command()
+def run(
+    messages: int = 10000,
+    latency: float = 0.005,
+    flood_rate: float = 0.0,
+):
+    """Run all benchmarks, each in a process of its own, and print a summary."""
+    typer.echo(
+        f"{'path':<6}{'database':<10}{'msg/s':>10}{'dl/s':>10}"
+        f"{'queries/msg':>13}{'files':>8}{'floods':>8}{'seconds':>9}{'peak MB':>9}"
+    )
+    for path in paths:
+        for database in databases:
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "single",
+                    path,
+                    database,
+                    f"--messages={messages}",
+                    f"--latency={latency}",
+                    f"--flood-rate={flood_rate}",
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            results = json.loads(output.strip().splitlines()[-1])
+            typer.echo(
+                f"{path:<6}{database:<10}"
+                f"{results['messages_per_second']:>10.0f}"
+                f"{results['downloads_per_second']:>10.0f}"
+                f"{results['queries_per_message']:>13.2f}"
+                f"{results['files']:>8}"
+                f"{results['flood_waits']:>8}"
+                f"{results['seconds']:>9.1f}"
+                f"{results['peak_memory_mb']:>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,221 @@
+"""A local stand-in for the TelegramClient and synthetic message streams.
+
+Messages are real telethon messages, so the bot handles them exactly like live ones.
+Only the network is replaced. Downloads write generated bytes after a simulated latency.
+"""
+import asyncio
+import random
+
+from telethon import types, utils
+from telethon.entitycache import EntityCache
+from telethon.errors import FloodWaitError
+from telethon.tl.custom import Message
+
+# Our own user id. Commands are sent by this user.
+SELF_ID = 1
+# The data center of all generated media.
+DC_ID = 2
+
+
+class FakeTelegramClient:
+    """Answer the requests of the bot without any network."""
+
+    def __init__(self, history=None, latency=0.0, flood_rate=0.0, flood_seconds=0):
+        """Create a new client for a chat with the given message history."""
+        self._self_id = SELF_ID
+        self._entity_cache = EntityCache()
+        self.history = history or []
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.random = random.Random(0)
+
+        self.downloads = 0
+        self.flood_waits = 0
+
+    async def get_me(self, input_peer=False):
+        """Get our own user."""
+        return types.User(id=SELF_ID, username="archivebot")
+
+    async def get_entity(self, peer):
+        """Resolve every user id to a user with a generated name."""
+        user_id = utils.get_peer_id(peer)
+        return types.User(id=user_id, username=f"user{user_id}", first_name="User")
+
+    async def get_messages(self, entity, ids=None):
+        """Get messages of the history by id."""
+        messages = {message.id: message for message in self.history}
+        return [messages.get(message_id) for message_id in ids]
+
+    def iter_messages(self, entity, filter=None, offset_id=0, **kwargs):
+        """Iterate over the history from the newest to the oldest message.
+
+        Server-side filters are emulated for the media types of the synthetic stream.
+        """
+
+        async def iterate():
+            for message in reversed(self.history):
+                if offset_id and message.id >= offset_id:
+                    continue
+                if matches_filter(message, filter):
+                    yield message
+
+        return iterate()
+
+    async def download_media(self, message, file=None, **kwargs):
+        """Write generated data for the media of a message after the simulated latency."""
+        await asyncio.sleep(self.latency)
+        if self.random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+        data = b"\0" * get_media_size(message)
+        self.downloads += 1
+        if hasattr(file, "write"):
+            file.write(data)
+            return file
+
+        if "." not in file.rsplit("/", maxsplit=1)[-1]:
+            file += utils.get_extension(message.media)
+        with open(file, "wb") as file_descriptor:
+            file_descriptor.write(data)
+
+        return file
+
+
+class FakeEvent:
+    """A NewMessage event for a message."""
+
+    def __init__(self, message, client):
+        """Create a new event."""
+        self.message = message
+        self.client = client
+
+    async def respond(self, text, **kwargs):
+        """Respond with a message, that can be edited later on."""
+        return FakeResponse()
+
+
+class FakeResponse:
+    """A message sent by the bot."""
+
+    async def edit(self, text, **kwargs):
+        """Messages are edited for progress updates."""
+
+
+def matches_filter(message, filter):
+    """Check whether a message would be returned for a search filter."""
+    if filter is None:
+        return True
+    if filter is types.InputMessagesFilterPhotos:
+        return message.photo is not None
+    if filter is types.InputMessagesFilterDocument:
+        return message.document is not None and message.sticker is None
+
+    # There are no videos, gifs, music or voice messages in synthetic streams.
+    return False
+
+
+def get_media_size(message):
+    """Get the size of the generated data for a message."""
+    if message.document is not None:
+        return message.document.size
+
+    return 64 * 1024
+
+
+def create_message(client, message_id, chat_id, user_id, media=None, fwd_from=None):
+    """Create a telethon message in a channel."""
+    message = Message(
+        id=message_id,
+        peer_id=types.PeerChannel(chat_id),
+        from_id=types.PeerUser(user_id),
+        message="",
+        media=media,
+        fwd_from=fwd_from,
+    )
+    message._finish_init(client, {}, None)
+    return message
+
+
+def create_command(client, chat_id, text, message_id=10**9):
+    """Create a command message, which is addressed to the bot."""
+    message = create_message(client, message_id, chat_id, SELF_ID)
+    message.message = text
+    message.out = True
+    return message
+
+
+def create_document(media_id, file_name, size, sticker=False):
+    """Create the media of a document with a file name."""
+    attributes = [types.DocumentAttributeFilename(file_name=file_name)]
+    if sticker:
+        attributes.append(
+            types.DocumentAttributeSticker(
+                alt="", stickerset=types.InputStickerSetEmpty()
+            )
+        )
+
+    return types.MessageMediaDocument(
+        document=types.Document(
+            id=media_id,
+            access_hash=0,
+            file_reference=b"",
+            date=None,
+            mime_type="image/webp" if sticker else "application/octet-stream",
+            size=size,
+            dc_id=DC_ID,
+            attributes=attributes,
+        )
+    )
+
+
+def create_photo(media_id):
+    """Create the media of a photo."""
+    return types.MessageMediaPhoto(
+        photo=types.Photo(
+            id=media_id,
+            access_hash=0,
+            file_reference=b"",
+            date=None,
+            sizes=[types.PhotoSize(type="x", w=800, h=600, size=64 * 1024)],
+            dc_id=DC_ID,
+        )
+    )
+
+
+def generate_messages(client, count, chat_id, users=20, seed=0):
+    """Generate a realistic mix of messages in a chat.
+
+    Every tenth file name is repeated, some messages are forwarded
+    and a third of all messages don't contain any media.
+    """
+    generator = random.Random(seed)
+    messages = []
+    for message_id in range(1, count + 1):
+        user_id = 1000 + generator.randrange(users)
+        media_id = 10**12 + message_id
+        kind = generator.random()
+
+        if kind < 0.35:
+            name = f"file_{message_id % (count // 10 + 1)}.bin"
+            size = generator.randrange(1024, 256 * 1024)
+            media = create_document(media_id, name, size)
+        elif kind < 0.55:
+            media = create_photo(media_id)
+        elif kind < 0.65:
+            media = create_document(media_id, "sticker.webp", 16 * 1024, sticker=True)
+        else:
+            media = None
+
+        fwd_from = None
+        if media is not None and generator.random() < 0.1:
+            fwd_from = types.MessageFwdHeader(
+                date=None, from_id=types.PeerUser(2000 + generator.randrange(users))
+            )
+
+        messages.append(
+            create_message(client, message_id, chat_id, user_id, media, fwd_from)
+        )
+
+    return messages
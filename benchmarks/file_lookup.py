@@ -0,0 +1,193 @@
+#!/bin/env python
+"""Benchmark the latency of file lookups on large file tables.
+
+A fresh SQLite database is filled with generated files for each table size.
+Afterwards the lookups of the bot are timed with the asyncio engine.
+
+Run it from the repository root:
+
+    python benchmarks/file_lookup.py --rows 1000000 --rows 10000000
+
+Use `--without-indexes` to compare the numbers with an unindexed table.
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+import typer
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from archivebot.db import base  # noqa
+from archivebot.models import File, Subscriber  # noqa
+
+INSERT_BATCH_SIZE = 50000
+QUERY_BATCH_SIZE = 100
+
+cli = typer.Typer()
+
+
+def fill_database(engine, rows, subscribers, indexes):
+    """Create the schema and insert the generated subscribers and files."""
+    base.metadata.create_all(bind=engine)
+
+    # Bulk loading is a lot faster without indexes. They are created afterwards.
+    file_indexes = list(File.__table__.indexes)
+    with engine.begin() as connection:
+        for index in file_indexes:
+            index.drop(bind=connection)
+
+        connection.execute(
+            Subscriber.__table__.insert(),
+            [
+                {
+                    "chat_id": chat_id,
+                    "chat_type": "channel",
+                    "chat_name": str(chat_id),
+                    "accepted_media": "document",
+                    "allow_duplicates": True,
+                    "active": True,
+                    "verbose": False,
+                    "sort_by_user": True,
+                }
+                for chat_id in range(subscribers)
+            ],
+        )
+
+        start = datetime.now() - timedelta(seconds=rows)
+        for offset in range(0, rows, INSERT_BATCH_SIZE):
+            connection.execute(
+                File.__table__.insert(),
+                [
+                    {
+                        "message_id": number,
+                        "to_id": number % subscribers,
+                        "from_id": 1,
+                        "to_type": "channel",
+                        "file_id": get_file_id(number),
+                        "file_type": "document",
+                        "file_name": f"{number}.bin",
+                        "file_path": f"/archive/{number % subscribers}/{number}.bin",
+                        "success": True,
+                        "downloaded_at": start + timedelta(seconds=number),
+                        "attempts": 0,
+                        "subscriber_chat_id": number % subscribers,
+                        "subscriber_chat_type": "channel",
+                    }
+                    for number in range(offset, min(rows, offset + INSERT_BATCH_SIZE))
+                ],
+            )
+
+        if indexes:
+            for index in file_indexes:
+                index.create(bind=connection)
+
+
+def get_file_id(number):
+    """Get a media id, which looks like a telegram media id."""
+    return 5000000000000000000 + number * 7919
+
+
+async def time_query(session, query):
+    """Execute a query and return the latency in milliseconds."""
+    start = time.perf_counter()
+    result = await session.execute(query)
+    result.all()
+    return (time.perf_counter() - start) * 1000
+
+
+async def run_lookups(url, rows, subscribers, lookups):
+    """Time the lookups, which are done for each message and each scan batch."""
+    engine = create_async_engine(url)
+    timings = {"exists": [], "known_file_ids": [], "downloaded_since": []}
+
+    async with AsyncSession(engine) as session:
+        chats = (await session.execute(select(Subscriber))).scalars().all()
+        for _ in range(lookups):
+            subscriber = random.choice(chats)
+            # Half of the lookups are for unknown files.
+            numbers = [random.randrange(rows * 2) for _ in range(QUERY_BATCH_SIZE)]
+            file_ids = [get_file_id(number) for number in numbers]
+
+            timings["exists"].append(
+                await time_query(
+                    session,
+                    select(File)
+                    .where(File.file_id == file_ids[0])
+                    .where(File.subscriber == subscriber),
+                )
+            )
+            timings["known_file_ids"].append(
+                await time_query(
+                    session,
+                    select(File.file_id)
+                    .where(File.file_id.in_(file_ids))
+                    .where(File.subscriber == subscriber),
+                )
+            )
+            # The newest files of a chat, like for an incremental export.
+            since = datetime.now() - timedelta(seconds=QUERY_BATCH_SIZE * subscribers)
+            timings["downloaded_since"].append(
+                await time_query(
+                    session,
+                    select(File.file_path)
+                    .where(File.subscriber == subscriber)
+                    .where(File.success.is_(True))
+                    .where(File.downloaded_at > since),
+                )
+            )
+
+    await engine.dispose()
+    return timings
+
+
+def print_timings(rows, timings):
+    """Print the median and the 99th percentile of all lookups."""
+    typer.echo(f"{rows} rows:")
+    for name, values in timings.items():
+        values.sort()
+        p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+        typer.echo(
+            f"    {name:<18} p50 {statistics.median(values):8.3f}ms   p99 {p99:8.3f}ms"
+        )
+
+
+@cli.command()
+def main(
+    rows: List[int] = typer.Option([1000000, 10000000]),
+    subscribers: int = 100,
+    lookups: int = 1000,
+    without_indexes: bool = False,
+):
+    """Fill databases of the given sizes and time the file lookups."""
+    for row_count in rows:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "benchmark.db")
+            typer.echo(f"Inserting {row_count} files... ", nl=False)
+            start = time.perf_counter()
+            fill_database(
+                create_engine(f"sqlite:///{path}"),
+                row_count,
+                subscribers,
+                not without_indexes,
+            )
+            typer.echo(f"done in {time.perf_counter() - start:.1f}s")
+
+            timings = asyncio.run(
+                run_lookups(
+                    f"sqlite+aiosqlite:///{path}", row_count, subscribers, lookups
+                )
+            )
+            print_timings(row_count, timings)
+
+
+if __name__ == "__main__":
+    cli()
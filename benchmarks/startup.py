@@ -0,0 +1,90 @@
+#!/bin/env python
+"""Measure the startup time of the command line.
+
+Every command runs in a fresh process with a temporary configuration and database,
+just like it would from cron or in a container.
+`run` can't be started without a telegram account, so the import of the bot is measured instead.
+
+Run it from the repository root:
+
+    python benchmarks/startup.py --repetitions 10
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import toml
+import typer
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT_DIR, "main.py")
+
+commands = {
+    "--help": [MAIN, "--help"],
+    "initdb": [MAIN, "initdb", "--drop-existing"],
+    "migrate": [MAIN, "migrate"],
+    "import bot": ["-c", "import archivebot.archivebot"],
+}
+
+cli = typer.Typer()
+
+
+def write_config(directory):
+    """Write the configuration for the benchmark and return the environment to use it."""
+    config_path = os.path.join(directory, "archivebot.toml")
+    with open(config_path, "w") as file_descriptor:
+        toml.dump(
+            {
+                "telegram": {"app_api_id": 1, "app_api_hash": "benchmark"},
+                "database": {
+                    "sql_uri": f"sqlite:///{os.path.join(directory, 'archivebot.db')}"
+                },
+                "download": {"target_dir": os.path.join(directory, "files")},
+            },
+            file_descriptor,
+        )
+
+    environment = dict(os.environ)
+    environment["ARCHIVEBOT_CONFIG"] = config_path
+    environment["PYTHONPATH"] = ROOT_DIR
+    return environment
+
+
+def measure(arguments, environment, directory):
+    """Run a command in a new process and return its wall time in seconds."""
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, *arguments],
+        check=True,
+        cwd=directory,
+        env=environment,
+        stdout=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+@cli.command()
+def run(repetitions: int = 10):
+    """Run every command several times and print the median and minimum wall time."""
+    typer.echo(f"{'command':<12}{'median ms':>12}{'min ms':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        environment = write_config(directory)
+        # Warm up the file system cache and create the database for `migrate`.
+        measure(commands["initdb"], environment, directory)
+
+        for name, arguments in commands.items():
+            times = [
+                measure(arguments, environment, directory) for _ in range(repetitions)
+            ]
+            typer.echo(
+                f"{name:<12}"
+                f"{statistics.median(times) * 1000:>12.0f}"
+                f"{min(times) * 1000:>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,17 +1,37 @@
 #!/bin/env python
-"""The main entry point for the bot."""
+"""The main entry point for the bot.
+
+Subsystems are imported inside of the commands, so each command only pays for what it uses.
+E.g. the telegram client is only built for `run`, and `--help` doesn't even touch the database.
+"""
+import os
 from contextlib import contextmanager
 
 import typer
-from sqlalchemy_utils.functions import database_exists, create_database, drop_database
-
-from archivebot.db import engine, base
-from archivebot.models import *  # noqa
-from archivebot.archivebot import main
 
 cli = typer.Typer()
 
 
+@cli.callback(help="Archive the files of telegram chats.")
+def check_config():
+    """Create the default config on the first start and ask the user to adjust it."""
+    from archivebot.config import config_exists, config_path, create_default_config
+
+    if not config_exists:
+        create_default_config()
+        typer.echo(f"Please adjust the configuration file at '{config_path}'")
+        raise typer.Exit(1)
+
+
+def get_alembic_config():
+    """Get the alembic configuration of the bot."""
+    from alembic.config import Config
+
+    return Config(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")
+    )
+
+
 @contextmanager
 def wrap_echo(msg: str):
     typer.echo(f"{msg}... ", nl=False)
@@ -25,6 +45,16 @@ def initdb(exist_ok: bool = False, drop_existing: bool = False):
 
     Can be used to remove an existing database.
     """
+    from alembic import command
+    from sqlalchemy_utils.functions import (
+        create_database,
+        database_exists,
+        drop_database,
+    )
+
+    import archivebot.models  # noqa
+    from archivebot.db import base, engine
+
     db_url = engine.url
     typer.echo(f"Using database at {db_url}")
 
@@ -49,12 +79,93 @@ def initdb(exist_ok: bool = False, drop_existing: bool = False):
         base.metadata.create_all()
         pass
 
+    # The schema is already up to date, mark it as such for future migrations.
+    with wrap_echo("Stamping schema revision"):
+        command.stamp(get_alembic_config(), "head")
+
     typer.echo("Database initialization complete.")
 
 
+@cli.command()
+def migrate():
+    """Migrate the database schema to the newest revision."""
+    from alembic import command
+    from sqlalchemy import inspect
+
+    from archivebot.db import engine
+
+    config = get_alembic_config()
+    typer.echo(f"Using database at {engine.url}")
+
+    # Databases from before the first migration only contain the initial schema.
+    tables = inspect(engine).get_table_names()
+    if "subscriber" in tables and "alembic_version" not in tables:
+        with wrap_echo("Stamping initial schema revision"):
+            command.stamp(config, "0001")
+
+    with wrap_echo("Migrating schema"):
+        command.upgrade(config, "head")
+
+    typer.echo("Database migration complete.")
+
+
+def require_local_storage():
+    """Abort the maintenance commands, since they only know the local file system."""
+    from archivebot.config import config
+
+    if config["storage"]["backend"] != "local":
+        typer.echo("Only the local storage backend can be maintained.", err=True)
+        raise typer.Exit(1)
+
+
+@cli.command()
+def verify(rehash: bool = False, workers: int = 8):
+    """Compare the database with the files on disk without changing anything.
+
+    With --rehash, deduplicated files are checked against the hash of their content.
+    """
+    require_local_storage()
+    from archivebot.maintenance import verify as verify_storage
+
+    typer.echo(verify_storage(rehash, workers).get_text())
+
+
+@cli.command()
+def reconcile(rehash: bool = False, workers: int = 8):
+    """Fix the database after files have been changed on disk.
+
+    Missing and broken files are downloaded again on the next start.
+    Files without a database entry are registered as orphans.
+    Blobs, which aren't used by any file anymore, are removed.
+    """
+    require_local_storage()
+    from archivebot.maintenance import reconcile as reconcile_storage
+
+    report = reconcile_storage(rehash, workers)
+    typer.echo(report.get_text())
+    typer.echo(f"Marked {len(report.get_broken())} files for a new download.")
+    typer.echo(
+        f"Removed {report.removed_blobs} unreferenced blobs "
+        f"({report.freed_bytes / 1024**3:.2f} GiB)."
+    )
+
+
+@cli.command()
+def reindex(workers: int = 8):
+    """Rebuild the file sizes and the storage counters of all chats from disk."""
+    require_local_storage()
+    from archivebot.maintenance import reindex as reindex_storage
+
+    with wrap_echo("Reindexing storage"):
+        count = reindex_storage(workers)
+    typer.echo(f"Filled in the size of {count} files.")
+
+
 @cli.command()
 def run():
     """Actually start the bot."""
+    from archivebot.archivebot import main
+
     main()
 
 